@@ -4,13 +4,15 @@
 # network and making an ε-greedy choice among the three possible actions during each timestep.
 
 import random
-from collections import defaultdict
+import numpy as np
+from environment.coarsecoder import pack_state_keys, state_key, unpack_state_keys
 
 
 class Actor:
     """
     The actor class keeps track of the policy to be used when deciding next move.
-    Uses dictionaries to keep track of the value of each SAP pair and eligibility.
+    Every distinct state is mapped to a row once, and the value and eligibility of each SAP pair
+    are kept in (n_states, n_actions) numpy tables that grow geometrically.
     """
 
     def __init__(self, config):
@@ -20,14 +22,32 @@ class Actor:
         :param discount_factor: float
         :param eli_decay: float
         :param epsilon: float
+        :param actions: list[int] (optional, the columns of the tables)
+        :param table_dtype: str (optional, float64 reproduces the updates of plain python floats exactly)
+        :param initial_capacity: int (optional, number of state rows allocated up front)
+        :param trace_cutoff: float (optional, eligibility traces decayed below this are dropped)
         """
         self.epsilon = config["epsilon"]
         self.epsilon_decay = config["epsilon_decay"]
-        self.policy_dict = defaultdict(lambda: 0)
-        self.eli_dict = {}  # defaultdict(lambda: 0)
         self.discount_factor = config["discount_factor"]
         self.eli_decay = config["eli_decay"]
         self.learning_rate = config["learning_rate"]
+        self.table_dtype = np.dtype(config.get("table_dtype", "float32"))
+        self._set_actions(config.get("actions", [1, 0, -1]))
+        self.state_index = {}
+        self.state_keys = []
+        self.policy_table = np.zeros(
+            (config.get("initial_capacity", 1024), len(self.actions)), dtype=self.table_dtype)
+        self.eli_table = np.zeros_like(self.policy_table)
+        # Live eligibility traces as parallel (row, column) index arrays, and the position of each pair in them
+        self.trace_cutoff = config.get("trace_cutoff", 1e-4)
+        self._trace_rows = np.empty(0, dtype=np.intp)
+        self._trace_cols = np.empty(0, dtype=np.intp)
+        self._trace_slots = {}
+
+    @property
+    def n_states(self):
+        return len(self.state_keys)
 
     def update_policy_dict(self, state, action, td_err):
         """
@@ -37,12 +57,9 @@ class Actor:
         :param action: list[tuple(int,int)]
         :param td_err: float
         """
-        if (str(state), str(action)) in self.policy_dict.keys():
-            self.policy_dict[(str(state), str(action))] += self.learning_rate * \
-                td_err * self.get_elig(str(state), str(action))
-        else:
-            self.policy_dict[(str(state), str(action))] = self.learning_rate * \
-                td_err * self.get_elig(state, action)
+        row, col = self._add_state(state), self.action_index[action]
+        self.policy_table[row, col] += self.learning_rate * \
+            td_err * self.eli_table[row, col]
 
     # Updates eligibility using: discount_factor*eli_decay*eli_dict[state,action]
 
@@ -55,14 +72,44 @@ class Actor:
         :param i: int (0 for current state)
 
         """
+        row, col = self._add_state(state), self.action_index[action]
         if i == 0:
-            self.eli_dict[(str(state), str(action))] = 1
-            return
+            self.eli_table[row, col] = 1
         else:
-            value = self.get_elig(state, action) * \
+            self.eli_table[row, col] = self.eli_table[row, col] * \
+                self.discount_factor * self.eli_decay
+
+    def step_update(self, state, action, td_err):
+        """
+        Performs one incremental TD(lambda) update after taking action in state.
+        All live traces are decayed by discount_factor*eli_decay, traces that fall below trace_cutoff are dropped,
+        the trace of (state, action) is set to 1 (a repeated pair replaces its trace rather than adding a new one),
+        and finally every SAP pair with a live trace is updated with learning_rate*td_err*eligibility.
+        Costs O(number of live traces) rather than O(steps taken so far in the episode).
+        :param state: tuple(int) or numpy array
+        :param action: int
+        :param td_err: float
+        """
+        rows, cols = self._trace_rows, self._trace_cols
+        if len(rows):
+            traces = self.eli_table[rows, cols] * \
                 self.discount_factor * self.eli_decay
-            element = {(str(state), str(action)): value}
-            self.eli_dict.update(element)
+            self.eli_table[rows, cols] = traces
+            expired = traces < self.trace_cutoff
+            if expired.any():
+                self.eli_table[rows[expired], cols[expired]] = 0
+                rows, cols = rows[~expired], cols[~expired]
+                self._trace_slots = {pair: slot for slot, pair in enumerate(zip(rows.tolist(), cols.tolist()))}
+
+        row, col = self._add_state(state), self.action_index[action]
+        self.eli_table[row, col] = 1
+        if (row, col) not in self._trace_slots:
+            self._trace_slots[(row, col)] = len(rows)
+            rows, cols = np.append(rows, row), np.append(cols, col)
+        self._trace_rows, self._trace_cols = rows, cols
+
+        self.policy_table[rows, cols] += self.learning_rate * \
+            td_err * self.eli_table[rows, cols]
 
     def get_elig(self, state, action):
         """
@@ -70,10 +117,10 @@ class Actor:
         :param state: list[list[int]]
         :param action: list[tuple(int,int)]
         """
-        if (str(state), str(action)) in self.eli_dict.keys():
-            return self.eli_dict[(str(state), str(action))]
-        else:
+        row = self.state_index.get(state_key(state))
+        if row is None:
             return 0
+        return self.eli_table[row, self.action_index[action]]
 
     def get_policy(self, state, action):
         """
@@ -82,17 +129,19 @@ class Actor:
         :param state: list[list[int]]
         :param action: list[tuple(int,int)]
         """
-
-        if (str(state), str(action)) in self.policy_dict.keys():
-            return self.policy_dict[(str(state), str(action))]
-        else:
+        row = self.state_index.get(state_key(state))
+        if row is None:
             return 0
+        return self.policy_table[row, self.action_index[action]]
 
     def reset_eli_dict(self):
         """
-        Reset eli_dict after episode ends
+        Reset eligibilities after episode ends
         """
-        self.eli_dict = {}
+        self.eli_table[:self.n_states] = 0
+        self._trace_rows = np.empty(0, dtype=np.intp)
+        self._trace_cols = np.empty(0, dtype=np.intp)
+        self._trace_slots = {}
 
     def get_action(self, state, legal_actions):
         """
@@ -103,5 +152,133 @@ class Actor:
         """
         self.epsilon = self.epsilon*self.epsilon_decay
         if random.uniform(0, 1) >= self.epsilon:
-            return max(legal_actions, key=lambda action: self.get_policy(state, action))
+            row = self.state_index.get(state_key(state))
+            if row is None:
+                # Every action has the default value 0, so the first legal action wins like in max()
+                return legal_actions[0]
+            if legal_actions == self.actions:
+                return self.actions[int(np.argmax(self.policy_table[row]))]
+            values = self.policy_table[row, [self.action_index[action] for action in legal_actions]]
+            return legal_actions[int(np.argmax(values))]
         return random.choice(legal_actions)
+
+    def get_greedy_actions(self, states):
+        """
+        Returns the greedy action of many states at once, like get_action with epsilon 0 and every action legal.
+        Unseen states get the first action, and ties go to the first action with the highest value.
+        :param states: (n, n_tilings) active feature indices, or a numpy array of n dense encodings
+        :return: numpy array of n actions
+        """
+        states = np.asarray(states)
+        if states.ndim == 2:
+            keys = map(tuple, states.tolist())
+        else:
+            keys = (state_key(state) for state in states)
+        rows = np.fromiter((self.state_index.get(key, -1) for key in keys),
+                           dtype=np.intp, count=len(states))
+        columns = np.zeros(len(states), dtype=np.intp)
+        seen = rows >= 0
+        columns[seen] = np.argmax(self.policy_table[rows[seen]], axis=1)
+        return np.array(self.actions)[columns]
+
+    def _add_state(self, state):
+        """
+        Returns the row of a state, adding a new row (and growing the tables if they are full) for unseen states.
+        :param state: tuple(int) or numpy array
+        """
+        return self._add_key(state_key(state))
+
+    def _add_key(self, key):
+        """
+        Returns the row of a state key, adding a row for unseen keys.
+        :param key: key returned by state_key
+        """
+        row = self.state_index.get(key)
+        if row is None:
+            row = self.n_states
+            if row == len(self.policy_table):
+                self._grow_tables()
+            self.state_index[key] = row
+            self.state_keys.append(key)
+        return row
+
+    def add_to_policy(self, keys, deltas):
+        """
+        Adds deltas to the policy values of states given by their keys, adding rows for unseen states.
+        :param keys: list of distinct keys returned by state_key
+        :param deltas: numpy array of shape (len(keys), len(actions))
+        :return: numpy array with the rows of the states
+        """
+        rows = np.array([self._add_key(key) for key in keys], dtype=np.intp)
+        self.policy_table[rows] += deltas
+        return rows
+
+    def set_policy(self, keys, values):
+        """
+        Sets the policy values of states given by their keys, adding rows for unseen states.
+        :param keys: list of distinct keys returned by state_key
+        :param values: numpy array of shape (len(keys), len(actions))
+        """
+        rows = np.array([self._add_key(key) for key in keys], dtype=np.intp)
+        self.policy_table[rows] = values
+
+    def _grow_tables(self):
+        """
+        Doubles the number of rows in the policy and eligibility tables.
+        """
+        capacity = max(1, 2 * len(self.policy_table))
+        for name in ("policy_table", "eli_table"):
+            table = getattr(self, name)
+            grown = np.zeros((capacity, table.shape[1]), dtype=table.dtype)
+            grown[:len(table)] = table
+            setattr(self, name, grown)
+
+    def _set_actions(self, actions):
+        """
+        Sets the actions that make up the table columns. Actions can be looked up as ints or strings.
+        """
+        self.actions = list(actions)
+        self.action_index = {action: i for i, action in enumerate(self.actions)}
+        self.action_index.update({str(action): i for i, action in enumerate(self.actions)})
+
+    def get_tables(self):
+        """
+        Returns the state keys, actions and the used part of the policy and eligibility tables as numpy arrays.
+        """
+        keys, key_format = pack_state_keys(self.state_keys)
+        return {"keys": keys, "key_format": np.array(key_format), "actions": np.array(self.actions),
+                "policy": self.policy_table[:self.n_states], "eligibility": self.eli_table[:self.n_states]}
+
+    def set_tables(self, tables):
+        """
+        Replaces the tables with ones returned by get_tables. Live eligibility traces are dropped.
+        :param tables: dict of numpy arrays (or an open .npz file), without eligibility all eligibilities are 0
+        """
+        keys = unpack_state_keys(tables["keys"], str(tables["key_format"]))
+        self._set_actions(tables["actions"].tolist())
+        self.state_keys = keys
+        self.state_index = {key: row for row, key in enumerate(keys)}
+        self.policy_table = np.zeros(
+            (max(1, len(keys)), len(self.actions)), dtype=self.table_dtype)
+        self.eli_table = np.zeros_like(self.policy_table)
+        self.policy_table[:len(keys)] = tables["policy"]
+        if "eligibility" in tables:
+            self.eli_table[:len(keys)] = tables["eligibility"]
+        self._trace_rows = np.empty(0, dtype=np.intp)
+        self._trace_cols = np.empty(0, dtype=np.intp)
+        self._trace_slots = {}
+
+    def save_tables(self, file):
+        """
+        Saves the state keys and the used part of the policy and eligibility tables as an .npz file.
+        :param file: str or file object
+        """
+        np.savez(file, **self.get_tables())
+
+    def load_tables(self, file):
+        """
+        Replaces the tables with the ones saved by save_tables.
+        :param file: str or file object
+        """
+        with np.load(file) as data:
+            self.set_tables(data)
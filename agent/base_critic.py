@@ -0,0 +1,275 @@
+import random
+import numpy as np
+from environment.coarsecoder import state_key
+
+# Largest sparse batch converted in the reused input buffer, larger ones (value maps, evaluation grids) get a
+# temporary array, so they do not keep a buffer of their size alive
+MAX_BUFFERED_STATES = 256
+
+
+def create_critic(config, n_features):
+    """
+    Creates the critic backend selected by config["backend"], 'keras' (default) or 'numpy'.
+    Backends are imported here, so tensorflow is only loaded when the keras backend is used.
+    :param config: dict
+    :param n_features: int, width of the state encoding (TileEncoder.n_features)
+    """
+    backend = config.get("backend", "keras")
+    if backend == "keras":
+        from agent.critic import Critic
+        return Critic(config, n_features)
+    if backend == "numpy":
+        from agent.numpy_critic import NumpyCritic
+        return NumpyCritic(config, n_features)
+    raise ValueError(
+        "Unknown critic backend {}, expected 'keras' or 'numpy'".format(backend))
+
+
+class BaseCritic:
+    """
+    Shared part of the critic backends: seen-state tracking, TD-error and conversion of states to network input.
+    Backends implement predict_batch, train, _train_weighted, update_eligs, reset_eli_dict, get_weights and
+    set_weights, and count their weight updates in weight_version.
+    """
+
+    def __init__(self, config, n_features):
+        self.learning_rate = config["learning_rate"]
+        self.eli_decay = config["eli_decay"]
+        self.discount_factor = config["discount_factor"]
+        self.dims = self.create_dims(
+            internal_dims=config["internal_dims"], n_features=n_features)
+        # dense: the first layer multiplies a one-hot input, embedding: it sums the weight rows of the active features
+        self.first_layer = config.get("first_layer", "dense")
+        if self.first_layer not in ("dense", "embedding"):
+            raise ValueError(
+                "Unknown first_layer {}, expected 'dense' or 'embedding'".format(self.first_layer))
+        # Width of the first layer, the embedding can be narrower than the n_features of the dense layout
+        self.first_units = self.dims[0]
+        if self.first_layer == "embedding" and config.get("embedding_units"):
+            self.first_units = config["embedding_units"]
+        # Eligibilities of the embedding kernel only for recently active rows, see SparseTraces
+        self.sparse_traces = config.get("sparse_traces", False)
+        self.trace_cutoff = config.get("trace_cutoff", 1e-4)
+        if self.sparse_traces and self.first_layer != "embedding":
+            raise ValueError("sparse_traces needs first_layer: embedding")
+        # Keys of the states seen so far, unseen states get a random value instead of a prediction
+        self.studied = set()
+        self.n_studied = 0
+        self.track_studied = config.get("track_studied", True)
+        self.max_studied = config.get("max_studied")
+        # Reused input rows for sparse states, only the previously active entries are cleared between calls
+        self._input_buffer = np.zeros((2, self.dims[0]), dtype=np.float32)
+        self._active_inputs = (np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp))
+        # Last predicted V(s'), reused as V(s) on the next step if the weights have not changed since
+        self.weight_version = 0
+        self._cached_key = None
+        self._cached_value = None
+        self._cached_version = None
+
+    @staticmethod
+    def create_dims(internal_dims, n_features):
+        if not internal_dims or internal_dims == 0:
+            return [n_features] + [1]
+        return [n_features] + internal_dims + [1]
+
+    def reset_eli_dict(self):
+        """
+        Resets eligibilities (done before a new episode)
+        """
+        raise NotImplementedError
+
+    def update_eligs(self, *args):
+        """
+        Decays eligibilities for one step
+        """
+        raise NotImplementedError
+
+    def train(self, state, td_error):
+        """
+        Trains the value function after a new observation (td_error), using the eligibilities of earlier states
+        :param state: list(list(int))
+        :param td_error: float
+        """
+        raise NotImplementedError
+
+    def train_batch(self, states, td_errors):
+        """
+        Trains on a window of consecutive steps with one forward and backward pass. Gives the same result as
+        train(states[t], td_errors[t]) followed by update_eligs() for every t, except that every gradient is taken
+        at the weights from before the window, so the two agree up to O(learning_rate) per window.
+        Per step the weights move by learning_rate * td_t * e_t,
+        where e_t = (γλ)^t e_in + sum_j<=t (γλ)^(t-j) grad V(s_j).
+        Summed over the window that is (sum_t td_t (γλ)^t) e_in + grad sum_j c_j V(s_j) with c_j = td_j + γλ c_j+1,
+        and the eligibilities left after the window are (γλ)^n e_in + grad sum_j (γλ)^(n-j) V(s_j).
+        :param states: list of n states
+        :param td_errors: list of n floats
+        """
+        decay = self.discount_factor * self.eli_decay
+        td_errors = np.asarray(td_errors, dtype=np.float64)
+        n = len(td_errors)
+        td_weights = np.empty(n)
+        accumulated = 0.0
+        for j in reversed(range(n)):
+            accumulated = td_errors[j] + decay * accumulated
+            td_weights[j] = accumulated
+        trace_weights = decay ** np.arange(n, 0, -1, dtype=np.float64)
+        carry = float(td_errors @ decay ** np.arange(n, dtype=np.float64))
+        self.weight_version += 1
+        self._train_weighted(self.convert_states_to_tensor(states), td_weights, trace_weights, carry, decay ** n)
+
+    def _train_weighted(self, inputs, td_weights, trace_weights, carry, trace_decay):
+        """
+        Moves the weights by learning_rate * (carry * e + grad sum_j td_weights[j] V(inputs[j])), then sets the
+        eligibilities to trace_decay * e + grad sum_j trace_weights[j] V(inputs[j]). See train_batch.
+        :param inputs: network input of shape (n, dims[0])
+        :param td_weights: numpy array of shape (n,)
+        :param trace_weights: numpy array of shape (n,)
+        :param carry: float
+        :param trace_decay: float
+        """
+        raise NotImplementedError
+
+    def get_weights(self):
+        """
+        Returns the weights of the value function as a list of numpy arrays
+        """
+        raise NotImplementedError
+
+    def set_weights(self, weights):
+        """
+        Replaces the weights of the value function with a list returned by get_weights
+        :param weights: list of numpy arrays
+        """
+        raise NotImplementedError
+
+    def predict_batch(self, states):
+        """
+        Returns the predicted values of several states, with one call to the value function
+        :param states: list of states
+        :return: numpy array of shape (len(states),)
+        """
+        raise NotImplementedError
+
+    def predict(self, state):
+        """
+        Returns the predicted value of a state as a float
+        :param state: list(list(int))
+        """
+        return float(self.predict_batch([state])[0])
+
+    def compute_td_err(self, current_state, next_state, reward):
+        """
+        Computes TD-error after performing an action from current_state leading next_state and reward
+        Measures degree of surprise after a state transition
+        :param current_state: list(list(int))
+        :param next_state: list(list(int))
+        :param reward: integer
+        """
+        # Initialize unseen states (current and "next") as random float between 0 and 1
+        state_value = state_prime_value = None
+        if self.track_studied and self._study(current_state):
+            state_value = random.uniform(0, 1)
+        elif state_key(current_state) == self._cached_key and self._cached_version == self.weight_version:
+            # The value of this state was predicted as V(s') on the previous step, with the same weights
+            state_value = self._cached_value
+        if self.track_studied and state_key(next_state) not in self.studied:
+            state_prime_value = random.uniform(0, 1)
+
+        # Predict the values still missing with a single batched call
+        missing = [state for state, value in ((current_state, state_value), (next_state, state_prime_value))
+                   if value is None]
+        if missing:
+            predictions = self.predict_batch(missing)
+            if state_value is None:
+                state_value, predictions = float(predictions[0]), predictions[1:]
+            if state_prime_value is None:
+                state_prime_value = float(predictions[0])
+                self._cached_key = state_key(next_state)
+                self._cached_value = state_prime_value
+                self._cached_version = self.weight_version
+        # delta = r + V(s') - V(s)
+        return reward + self.discount_factor * state_prime_value - state_value
+
+    def compute_td_errs(self, states, rewards):
+        """
+        Computes the TD-errors of the transitions states[t] -> states[t+1] with rewards[t], with the same rules
+        (and the same draws of random values for unseen states) as calling compute_td_err on every transition,
+        but with all predictions made by one call with the current weights.
+        :param states: list of n + 1 consecutive states
+        :param rewards: list of n rewards
+        :return: numpy array of n TD-errors
+        """
+        n = len(rewards)
+        state_values = [None] * n
+        state_prime_values = [None] * n
+        for t in range(n):
+            if self.track_studied and self._study(states[t]):
+                state_values[t] = random.uniform(0, 1)
+            if self.track_studied and state_key(states[t + 1]) not in self.studied:
+                state_prime_values[t] = random.uniform(0, 1)
+        missing = sorted({t for t in range(n) if state_values[t] is None} |
+                         {t + 1 for t in range(n) if state_prime_values[t] is None})
+        predictions = {}
+        if missing:
+            predictions = dict(zip(missing, self.predict_batch([states[i] for i in missing]).tolist()))
+        state_values = np.array([predictions[t] if value is None else value
+                                 for t, value in enumerate(state_values)])
+        state_prime_values = np.array([predictions[t + 1] if value is None else value
+                                       for t, value in enumerate(state_prime_values)])
+        return np.asarray(rewards) + self.discount_factor * state_prime_values - state_values
+
+    def _study(self, state):
+        """
+        Marks a state as seen. Returns True if it had not been seen before.
+        Once max_studied distinct states have been seen the critic counts as warmed up,
+        and tracking is switched off so every state gets a predicted value.
+        :param state: tuple(int) or list(list(int))
+        """
+        key = state_key(state)
+        if key in self.studied:
+            return False
+        self.studied.add(key)
+        self.n_studied += 1
+        if self.max_studied is not None and self.n_studied >= self.max_studied:
+            self.track_studied = False
+            self.studied = set()
+        return True
+
+    def convert_state_to_tensor(self, state):
+        """
+        Converts a state to a network input of shape (1, dims[0]), see convert_states_to_tensor.
+        :param state: tuple(int) or list(list(int))
+        """
+        return self.convert_states_to_tensor([state])
+
+    def convert_states_to_tensor(self, states):
+        """
+        Converts a list of states to a network input of shape (len(states), dims[0]).
+        Sparse states (tuples or 1-d arrays of active feature indices, -1 for none) are written into a
+        preallocated float32 buffer, so the returned array is only valid until the next call. Batches of more than
+        MAX_BUFFERED_STATES states are written into a new array instead.
+        With the embedding first layer the input is the (len(states), n_tilings) int32 array of the indices itself.
+        :param states: list of tuple(int) or list(list(int))
+        """
+        sparse = isinstance(states[0], tuple) or np.ndim(states[0]) == 1
+        if self.first_layer == "embedding":
+            if not sparse:
+                raise ValueError(
+                    "first_layer: embedding needs sparse states (Environment.sparse_state: True)")
+            return np.asarray(states, dtype=np.int32).reshape(len(states), -1)
+        if sparse:
+            indices = np.asarray(states).reshape(len(states), -1)
+            rows, tilings = np.nonzero(indices >= 0)
+            if len(states) > MAX_BUFFERED_STATES:
+                inputs = np.zeros((len(states), self.dims[0]), dtype=np.float32)
+                inputs[rows, indices[rows, tilings]] = 1
+                return inputs
+            if len(states) > len(self._input_buffer):
+                self._input_buffer = np.zeros(
+                    (len(states), self.dims[0]), dtype=np.float32)
+            buffer = self._input_buffer
+            buffer[self._active_inputs] = 0
+            self._active_inputs = (rows, indices[rows, tilings])
+            buffer[self._active_inputs] = 1
+            return buffer[:len(states)]
+        return np.asarray(states, dtype=np.float32).reshape(len(states), -1)
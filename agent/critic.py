@@ -1,27 +1,49 @@
-import random
-import numpy as np
 import tensorflow as tf
 from tensorflow import keras
+from agent.base_critic import BaseCritic
 from agent.split_gd import SplitGD
 
 
-class Critic:
-    def __init__(self, config, granularity):
-        self.learning_rate = config["learning_rate"]
-        self.eli_decay = config["eli_decay"]
-        self.discount_factor = config["discount_factor"]
-        self.dims = Critic.create_dims(
-            internal_dims=config["internal_dims"], granularity=granularity)
+class SparseDense(keras.layers.Layer):
+    """
+    Dense layer for one-hot inputs given as the indices of their ones (-1 for none).
+    The output is the sum of the gathered kernel rows plus the bias, the same as a Dense layer on the one-hot vector,
+    with the same [kernel, bias] weights, but costs O(active inputs * units) instead of O(inputs * units),
+    and the kernel gradient only has the gathered rows (a tf.IndexedSlices). The kernel takes input_dim * units
+    memory, so units is kept well below input_dim for large tile codings.
+    """
+
+    def __init__(self, input_dim, units, activation=None, **kwargs):
+        super().__init__(**kwargs)
+        self.input_dim = input_dim
+        self.units = units
+        self.activation = keras.activations.get(activation)
+
+    def build(self, input_shape):
+        self.kernel = self.add_weight(shape=(self.input_dim, self.units), initializer="glorot_uniform",
+                                      name="kernel")
+        self.bias = self.add_weight(
+            shape=(self.units,), initializer="zeros", name="bias")
+
+    def call(self, indices):
+        indices = tf.cast(indices, tf.int32)
+        active = tf.cast(indices >= 0, self.kernel.dtype)
+        rows = tf.gather(self.kernel, tf.maximum(indices, 0)) * active[..., None]
+        return self.activation(tf.reduce_sum(rows, axis=1) + self.bias)
+
+
+class Critic(BaseCritic):
+    """
+    Critic backed by a keras network, trained with eligibility traces through SplitGD.
+    """
+
+    def __init__(self, config, n_features):
+        super().__init__(config, n_features)
         self.model = self.gennet(self.dims, learning_rate=self.learning_rate)
         self.splitGD = SplitGD(self.model, self.learning_rate,
-                               self.discount_factor, self.eli_decay)
-        self.studied = []
-
-    @staticmethod
-    def create_dims(internal_dims, granularity):
-        if not internal_dims or internal_dims == 0:
-            return [granularity[0] * granularity[1] * 5] + [1]
-        return [granularity[0]*granularity[1] * 5] + internal_dims + [1]
+                               self.discount_factor, self.eli_decay,
+                               fused=config.get("fused_update", False),
+                               sparse_traces=self.sparse_traces, trace_cutoff=self.trace_cutoff)
 
     def reset_eli_dict(self):
         """
@@ -31,7 +53,7 @@ class Critic:
 
     def update_eligs(self, *args):
         """
-        Decays eligibilities for one step
+        Decays eligibilities for one step (a no-op with fused_update, where fit() already decays them)
         """
         self.splitGD.update_eligs()
 
@@ -43,49 +65,26 @@ class Critic:
         """
         state_tensor = self.convert_state_to_tensor(state)
         td_error_tensor = tf.reshape(td_error, [1, 1])
+        self.weight_version += 1
         self.model = self.splitGD.fit(
             state_tensor=state_tensor, td_error=td_error_tensor)
 
-    def compute_td_err(self, current_state, next_state, reward):
-        """
-        Computes TD-error after performing an action from current_state leading next_state and reward
-        Measures degree of surprise after a state transition
-        :param current_state: list(list(int))
-        :param next_state: list(list(int))
-        :param reward: integer
-        """
-        # Initialize unseen states as random float between 0 and 1
-        if self.nparray_in_2dnparray(current_state, self.studied):
-            # if current_state not in self.studied:
-            self.studied.append(current_state)
-            state_value = random.uniform(0, 1)
-        else:
-            # Predict value of current state
-            s = self.convert_state_to_tensor(current_state)
-            state_value = self.splitGD.model(s).numpy()[0][0]
+    def _train_weighted(self, inputs, td_weights, trace_weights, carry, trace_decay):
+        self.model = self.splitGD.fit_batch(inputs, td_weights, trace_weights, carry, trace_decay)
 
-        # Initialize unseen "next" states as random float between 0 and 1 as well
-        if self.nparray_in_2dnparray(next_state, self.studied):
-            state_prime_value = random.uniform(0, 1)
-        else:
-            # Predict value of new state
-            s_p = self.convert_state_to_tensor(next_state)
-            state_prime_value = self.splitGD.model(s_p).numpy()[0][0]
-        # delta = r + V(s') - V(s)
-        return reward + self.discount_factor * state_prime_value - state_value
+    def get_weights(self):
+        return self.model.get_weights()
+
+    def set_weights(self, weights):
+        self.model.set_weights(weights)
+        self.weight_version += 1
 
-    def convert_state_to_tensor(self, state):
+    def predict_batch(self, states):
         """
-        Converts a list representation of the state to a tensor
-        :param state: list(list(int))
+        Predicts the values of several states with one call to the network
+        :param states: list of states
         """
-        tensor = []
-        for i in range(len(state)):
-            for j in range(len(state[i])):
-                for k in range(len(state[i][j])):
-                    tensor.append(state[i][j][k])
-
-        return np.array([tensor])
+        return self.splitGD.model(self.convert_states_to_tensor(states)).numpy()[:, 0]
 
     def gennet(self, dims, learning_rate, opt='SGD', loss='MeanSquaredError()', activation="relu", last_activation="sigmoid"):
         """
@@ -96,8 +95,13 @@ class Critic:
         model = keras.models.Sequential()
         opt = eval('keras.optimizers.' + opt)
         loss = eval('tf.keras.losses.' + loss)
-        model.add(keras.layers.Dense(input_shape=(dims[0],),  # Determines shape after first input of a board state
-                                     units=dims[0], activation=activation))
+        if self.first_layer == "embedding":
+            # Takes the active feature indices of a state, any number of them
+            model.add(keras.Input(shape=(None,), dtype="int32"))
+            model.add(SparseDense(dims[0], units=self.first_units, activation=activation))
+        else:
+            model.add(keras.layers.Dense(input_shape=(dims[0],),  # Determines shape after first input of a board state
+                                         units=dims[0], activation=activation))
         for layer in range(1, len(dims)-1):
             model.add(keras.layers.Dense(
                 units=dims[layer], activation=activation))
@@ -105,13 +109,3 @@ class Critic:
             units=dims[-1], activation=last_activation))
         model.compile(optimizer=opt(learning_rate=learning_rate), loss=loss)
         return model
-
-    @staticmethod
-    def nparray_in_2dnparray(np_arr, two_d_np_arr):
-        match = False
-        index = 0
-        while not match and index < len(two_d_np_arr):
-            if np.array_equal(np_arr, two_d_np_arr[index]):
-                match = True
-            index += 1
-        return match
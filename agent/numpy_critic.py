@@ -0,0 +1,186 @@
+import numpy as np
+from agent.base_critic import BaseCritic
+from agent.sparse_traces import SparseTraces
+
+
+class NumpyCritic(BaseCritic):
+    """
+    Critic written in numpy, with manual gradients and eligibility traces, so tensorflow is never imported.
+    By default it has the same layout as the keras critic (a relu layer of width dims[0], the internal relu layers
+    and a sigmoid output), with linear: True the value is a plain linear function of the input features.
+    With first_layer: embedding the first layer sums the weight rows of the active features instead of
+    multiplying a one-hot input, its width is first_units, its gradient is given as the (rows, values) of the
+    active features, and with sparse_traces its eligibilities are kept in a SparseTraces store.
+    """
+
+    def __init__(self, config, n_features):
+        """
+        :param linear: bool (optional, use a linear value function instead of the network)
+        :param seed: int (optional, seed for the weight initialisation)
+        """
+        super().__init__(config, n_features)
+        self.linear = config.get("linear", False)
+        rng = np.random.default_rng(config.get("seed"))
+        if self.linear:
+            layer_sizes = [self.dims[0], 1]
+        else:
+            layer_sizes = [self.dims[0], self.first_units] + self.dims[1:]
+        self.weights = []
+        self.biases = []
+        for fan_in, fan_out in zip(layer_sizes[:-1], layer_sizes[1:]):
+            # Glorot uniform weights and zero biases, the keras defaults
+            limit = np.sqrt(6 / (fan_in + fan_out))
+            self.weights.append(rng.uniform(-limit, limit,
+                                            (fan_in, fan_out)).astype(np.float32))
+            self.biases.append(np.zeros(fan_out, dtype=np.float32))
+        self.weight_eligs = [np.zeros_like(w) for w in self.weights]
+        self.bias_eligs = [np.zeros_like(b) for b in self.biases]
+        self.kernel_traces = None
+        if self.sparse_traces:
+            self.kernel_traces = SparseTraces(*self.weights[0].shape, self.discount_factor * self.eli_decay,
+                                              cutoff=self.trace_cutoff)
+            self.weight_eligs[0] = np.zeros((0, self.weights[0].shape[1]), dtype=np.float32)
+
+    def reset_eli_dict(self):
+        """
+        Resets eligibilities (done before a new episode)
+        """
+        for elig in self.weight_eligs + self.bias_eligs:
+            elig.fill(0)
+        if self.kernel_traces is not None:
+            self.kernel_traces.reset()
+
+    def update_eligs(self, *args):
+        """
+        Decays eligibilities for one step
+        """
+        for elig in self.weight_eligs + self.bias_eligs:
+            elig *= self.discount_factor * self.eli_decay
+        if self.kernel_traces is not None:
+            self.kernel_traces.advance()
+
+    def train(self, state, td_error):
+        """
+        Adds the gradient of V(state) to the eligibilities and updates the weights with them.
+        Like SplitGD, which hands eligibility * td_error to an SGD optimizer as the gradient,
+        the step is w = w - learning_rate * td_error * e, so both backends learn the same way.
+        :param state: list(list(int))
+        :param td_error: float
+        """
+        activations = self._forward(self.convert_state_to_tensor(state))
+        weight_grads, bias_grads = self._gradients(activations)
+        self.weight_version += 1
+        step = self.learning_rate * float(td_error)
+        for i, (w, b, w_elig, b_elig, w_grad, b_grad) in enumerate(zip(self.weights, self.biases, self.weight_eligs,
+                                                                       self.bias_eligs, weight_grads, bias_grads)):
+            if i == 0 and self.kernel_traces is not None:
+                # Only the rows with a live trace are updated
+                self.kernel_traces.add(*w_grad)
+                rows, traces = self.kernel_traces.current()
+                w[rows] -= step * traces
+            elif i == 0 and self.first_layer == "embedding":
+                # The gradient only has the active rows, the dense traces still update every row
+                np.add.at(w_elig, *w_grad)
+                w -= step * w_elig
+            else:
+                w_elig += w_grad
+                w -= step * w_elig
+            b_elig += b_grad
+            b -= step * b_elig
+
+    def _train_weighted(self, inputs, td_weights, trace_weights, carry, trace_decay):
+        activations = self._forward(inputs)
+        weight_grads, bias_grads = self._gradients(activations, td_weights)
+        weight_traces, bias_traces = self._gradients(activations, trace_weights)
+        first = 0
+        if self.kernel_traces is not None:
+            # carry * e_in on the rows with a live trace plus the gradient rows, then n steps of lazy decay
+            kernel = self.weights[0]
+            rows, traces = self.kernel_traces.current()
+            kernel[rows] -= (self.learning_rate * carry * traces).astype(np.float32)
+            grad_rows, grad_values = weight_grads[0]
+            np.subtract.at(kernel, grad_rows, (self.learning_rate * grad_values).astype(np.float32))
+            self.kernel_traces.advance(len(td_weights))
+            self.kernel_traces.add(*weight_traces[0])
+            first = 1
+        elif self.first_layer == "embedding":
+            kernel, elig = self.weights[0], self.weight_eligs[0]
+            kernel -= (self.learning_rate * carry * elig).astype(np.float32)
+            grad_rows, grad_values = weight_grads[0]
+            np.subtract.at(kernel, grad_rows, (self.learning_rate * grad_values).astype(np.float32))
+            elig *= trace_decay
+            trace_rows, trace_values = weight_traces[0]
+            np.add.at(elig, trace_rows, trace_values.astype(np.float32))
+            first = 1
+        for params, eligs, grads, traces in ((self.weights[first:], self.weight_eligs[first:], weight_grads[first:],
+                                              weight_traces[first:]),
+                                             (self.biases, self.bias_eligs, bias_grads, bias_traces)):
+            for param, elig, grad, trace in zip(params, eligs, grads, traces):
+                param -= (self.learning_rate * (carry * elig + grad)).astype(np.float32)
+                elig *= trace_decay
+                elig += trace.astype(np.float32)
+
+    def get_weights(self):
+        """
+        Returns the weights and biases of every layer, in the order keras uses: [w0, b0, w1, b1, ...]
+        """
+        return [array.copy() for layer in zip(self.weights, self.biases) for array in layer]
+
+    def set_weights(self, weights):
+        self.weights = [np.array(w, dtype=np.float32) for w in weights[0::2]]
+        self.biases = [np.array(b, dtype=np.float32) for b in weights[1::2]]
+        self.weight_version += 1
+
+    def predict_batch(self, states):
+        """
+        Predicts the values of several states in one forward pass
+        :param states: list of states
+        """
+        return self._forward(self.convert_states_to_tensor(states))[-1][:, 0]
+
+    def _forward(self, x):
+        """
+        Runs the network on input x of shape (batch, dims[0]), or (batch, n_tilings) indices with the embedding.
+        :return: list with the input and the output of every layer
+        """
+        activations = [x]
+        last = len(self.weights) - 1
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            if i == 0 and self.first_layer == "embedding":
+                z = (w[np.maximum(x, 0)] * (x >= 0)[..., None]).sum(axis=1) + b
+            else:
+                z = activations[-1] @ w + b
+            if i < last:
+                activations.append(np.maximum(z, 0))
+            elif self.linear:
+                activations.append(z)
+            else:
+                activations.append(1 / (1 + np.exp(-z)))
+        return activations
+
+    def _gradients(self, activations, output_weights=None):
+        """
+        Backpropagates the gradient of the output (summed over the batch) with respect to every weight and bias.
+        :param activations: list returned by _forward
+        :param output_weights: numpy array of shape (batch,) (optional, weights of the outputs in the sum)
+        :return: (weight gradients, bias gradients), with the embedding the first kernel's gradient is given as
+                 (rows, values) of the active features, rows may repeat
+        """
+        output = activations[-1]
+        delta = np.ones_like(output) if self.linear else output * (1 - output)
+        if output_weights is not None:
+            delta = delta * output_weights[:, None]
+        weight_grads = [None] * len(self.weights)
+        bias_grads = [None] * len(self.biases)
+        for i in reversed(range(len(self.weights))):
+            if i == 0 and self.first_layer == "embedding":
+                # Only the rows of the active features get a gradient
+                indices = activations[0]
+                states, tilings = np.nonzero(indices >= 0)
+                weight_grads[0] = (indices[states, tilings], delta[states])
+            else:
+                weight_grads[i] = activations[i].T @ delta
+            bias_grads[i] = delta.sum(axis=0)
+            if i > 0:
+                delta = (delta @ self.weights[i].T) * (activations[i] > 0)
+        return weight_grads, bias_grads
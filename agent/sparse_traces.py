@@ -0,0 +1,85 @@
+import numpy as np
+
+
+class SparseTraces:
+    """
+    Eligibility traces of the rows of one parameter matrix, kept only for rows that were touched recently.
+    Decay is applied lazily: every row stores its trace as of the step it was last touched (its stamp), and
+    advance() only moves the step counter, so the trace of a row is value * decay ** (step - stamp).
+    Rows whose trace has decayed below cutoff are dropped, so the cost per step is proportional to the number of
+    recently active rows instead of the size of the matrix.
+    """
+
+    def __init__(self, n_rows, n_columns, decay, cutoff=1e-4, dtype=np.float32):
+        """
+        :param n_rows: int, rows of the parameter matrix
+        :param n_columns: int, columns of the parameter matrix
+        :param decay: float, discount_factor * eli_decay
+        :param cutoff: float, traces whose largest entry falls below this are dropped (0 keeps every row)
+        """
+        self.n_columns = n_columns
+        self.decay = decay
+        self.cutoff = cutoff
+        self.dtype = dtype
+        # Position of every row in rows/values/stamps, -1 for rows without a live trace
+        self._slots = np.full(n_rows, -1, dtype=np.intp)
+        self.rows = np.empty(0, dtype=np.intp)
+        self.reset()
+
+    def reset(self):
+        self._slots[self.rows] = -1
+        self.step = 0
+        self.rows = np.empty(0, dtype=np.intp)
+        self.values = np.empty((0, self.n_columns), dtype=self.dtype)
+        self.stamps = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def advance(self, steps=1):
+        """
+        Decays every trace by decay ** steps.
+        """
+        self.step += steps
+
+    def add(self, rows, values, scale=1.0):
+        """
+        Adds scale * values to the traces of rows (rows may repeat, their values are summed).
+        :param rows: int numpy array of shape (n,)
+        :param values: numpy array of shape (n, n_columns)
+        """
+        rows, inverse = np.unique(np.asarray(rows, dtype=np.intp), return_inverse=True)
+        summed = np.zeros((len(rows), self.n_columns), dtype=self.dtype)
+        np.add.at(summed, inverse.ravel(), np.asarray(values, dtype=self.dtype))
+        if scale != 1.0:
+            summed *= scale
+        slots = self._slots[rows]
+        known = slots >= 0
+        if known.any():
+            live = slots[known]
+            ages = self.step - self.stamps[live]
+            self.values[live] = self.values[live] * (self.decay ** ages)[:, None].astype(self.dtype) + summed[known]
+            self.stamps[live] = self.step
+        new = rows[~known]
+        if len(new):
+            self._slots[new] = np.arange(len(self.rows), len(self.rows) + len(new))
+            self.rows = np.concatenate((self.rows, new))
+            self.values = np.concatenate((self.values, summed[~known]))
+            self.stamps = np.concatenate((self.stamps, np.full(len(new), self.step, dtype=np.int64)))
+
+    def current(self):
+        """
+        Returns the rows with a live trace and their traces at the current step, dropping rows below cutoff.
+        :return: (rows, traces) numpy arrays of shapes (n,) and (n, n_columns)
+        """
+        scale = (self.decay ** (self.step - self.stamps)).astype(self.dtype)
+        traces = self.values * scale[:, None]
+        keep = np.abs(traces).max(axis=1, initial=0) >= self.cutoff
+        if not keep.all():
+            self._slots[self.rows[~keep]] = -1
+            self.rows = self.rows[keep]
+            self._slots[self.rows] = np.arange(len(self.rows))
+            traces = traces[keep]
+            self.values = traces
+            self.stamps = np.full(len(self.rows), self.step, dtype=np.int64)
+        return self.rows, traces
@@ -1,20 +1,43 @@
 import tensorflow as tf
-import warnings
 import numpy as np
+from agent.sparse_traces import SparseTraces
 
 
 class SplitGD:
     """
     Takes in a keras model and accommodates needs to modify gradients before applying them during backpropagation
     Uses eligibility traces to update params from previously seen states
+    In fused mode the eligibilities are tf.Variables shaped like the trainable weights, and the forward pass, gradient,
+    trace accumulation, weight update and trace decay run as one tf.function that is traced once.
+    The gradients of an embedding-gather first kernel are tf.IndexedSlices and are only ever added row by row.
+    With sparse_traces that kernel keeps its eligibilities in a SparseTraces store, and only its rows with a live
+    trace are updated. The trace bookkeeping
+    runs in numpy, so with fused the compiled step returns the kernel gradient instead of applying it.
     """
 
-    def __init__(self, keras_model, learning_rate, discount_factor, eli_decay):
+    def __init__(self, keras_model, learning_rate, discount_factor, eli_decay, fused=False, sparse_traces=False,
+                 trace_cutoff=1e-4):
         self.model = keras_model
-        self.eligs = np.array([])
+        self.eligs = []
         self.discount_factor = discount_factor
         self.learning_rate = learning_rate
         self.eli_decay = eli_decay
+        self.sparse_traces = None
+        if sparse_traces:
+            kernel = self.model.trainable_weights[0]
+            self.sparse_traces = SparseTraces(kernel.shape[0], kernel.shape[1], discount_factor * eli_decay,
+                                              cutoff=trace_cutoff)
+        self.fused = fused
+        if fused:
+            params = self._dense_trace_params()
+            self.elig_vars = [tf.Variable(tf.zeros_like(param), trainable=False)
+                              for param in params]
+            # Create the optimizer's slots up front, variables can not be created inside the traced step
+            self.model.optimizer.build(params)
+            self._fused_fit = tf.function(self._fused_step)
+            self._fused_fit_batch = tf.function(self._fused_batch_step, input_signature=[
+                tf.TensorSpec([None, None], tf.float32), tf.TensorSpec([None], tf.float32),
+                tf.TensorSpec([None], tf.float32), tf.TensorSpec([], tf.float32), tf.TensorSpec([], tf.float32)])
 
     def update_eligs(self):
         """
@@ -22,30 +45,42 @@ class SplitGD:
         Ensures that weights associated with states are updated with respect to
         how long ago they occurred during the episode.
         Discount by discount factor is also performed here
+        In fused mode the decay is already part of fit(), and this does nothing.
         """
-        self.eligs = np.multiply(
-            self.eligs, self.discount_factor * self.eli_decay)
+        if self.sparse_traces is not None:
+            self.sparse_traces.advance()
+        if self.fused:
+            return
+        self.eligs = [np.multiply(elig, self.discount_factor * self.eli_decay)
+                      for elig in self.eligs]
 
     def reset_eli_dict(self):
         """
         Resets eligibilities (done before a new episode)
         """
-        self.eligs = np.array([])
+        if self.fused:
+            for elig in self.elig_vars:
+                elig.assign(tf.zeros_like(elig))
+        else:
+            self.eligs = []
+        if self.sparse_traces is not None:
+            self.sparse_traces.reset()
 
     def modify_gradients(self, gradients, td_error):
         """
         Modifies the gradients before backpropagation is performed.
         Modification depends on td-error and eligibility
         """
-        warnings.filterwarnings("ignore")
         # Initializes new eligibilites after a reset (this will be done during the first fit() call in an episode)
         if len(self.eligs) == 0:
             # Gradients are a list of tensors, need to keep shape intact
-            self.eligs = tf.zeros(shape=np.shape(gradients), dtype=tf.float32)
+            self.eligs = [np.zeros(self._dense_shape(gradient), dtype=np.float32)
+                          for gradient in gradients]
         # Eligibilty depends on how active parameter was for input state e_i = e_i + grad
-        self.eligs = np.add(self.eligs, gradients, dtype=object)
+        self.eligs = [self._add_gradient(elig, gradient)
+                      for elig, gradient in zip(self.eligs, gradients)]
         # Gradients are changed to equal e_i * delta
-        gradients = np.multiply(self.eligs, td_error[0][0])
+        gradients = [np.multiply(elig, td_error[0][0]) for elig in self.eligs]
         return gradients
 
     def fit(self, state_tensor, td_error):
@@ -53,10 +88,169 @@ class SplitGD:
         Takes in state and td_error computed after moving to state prime
         Updates weights in neural net with respect to how active they were for current prediction and previous states
         """
+        if self.fused:
+            # Tensors of a fixed dtype and shape keep the tf.function from retracing
+            kernel_gradient = self._fused_fit(tf.convert_to_tensor(state_tensor, dtype=tf.float32),
+                                              tf.reshape(tf.cast(td_error, tf.float32), []))
+            if self.sparse_traces is not None:
+                self._add_kernel_gradient(kernel_gradient)
+                self._update_kernel(float(td_error[0][0]))
+            return self.model
+
         params = self.model.trainable_weights
         with tf.GradientTape() as tape:
             prediction = self.model(state_tensor)
-            gradients = tape.gradient(prediction, params)
-            gradients = self.modify_gradients(gradients, td_error)
-            self.model.optimizer.apply_gradients(
-                zip(gradients, params))
+        gradients = tape.gradient(prediction, params)
+        if self.sparse_traces is not None:
+            kernel_gradient, gradients, params = gradients[0], gradients[1:], params[1:]
+            self._add_kernel_gradient(kernel_gradient)
+            self._update_kernel(float(td_error[0][0]))
+        gradients = self.modify_gradients(gradients, td_error)
+        self.model.optimizer.apply_gradients(
+            zip(gradients, params))
+        return self.model
+
+    def _dense_trace_params(self):
+        """
+        The params with dense eligibilities, all but the first kernel with sparse_traces.
+        """
+        params = self.model.trainable_weights
+        return params if self.sparse_traces is None else params[1:]
+
+    @staticmethod
+    def _dense_shape(gradient):
+        """
+        Shape of the parameter a gradient belongs to.
+        """
+        if isinstance(gradient, tf.IndexedSlices):
+            return tuple(gradient.dense_shape.numpy())
+        return gradient.shape
+
+    @staticmethod
+    def _add_gradient(array, gradient, scale=1.0):
+        """
+        Adds scale * gradient to a numpy array in place, only the gathered rows of a tf.IndexedSlices gradient.
+        """
+        if isinstance(gradient, tf.IndexedSlices):
+            np.add.at(array, gradient.indices.numpy(), scale * gradient.values.numpy())
+        else:
+            array += scale * gradient.numpy()
+        return array
+
+    @staticmethod
+    def _plus_gradient(tensor, gradient):
+        """
+        tensor + gradient inside the compiled steps, adding only the gathered rows of a tf.IndexedSlices gradient.
+        """
+        if isinstance(gradient, tf.IndexedSlices):
+            return tf.tensor_scatter_nd_add(tensor, gradient.indices[:, None], gradient.values)
+        return tensor + gradient
+
+    def _add_kernel_gradient(self, gradient, steps=0):
+        """
+        Advances the sparse traces by steps and adds the rows of a tf.IndexedSlices kernel gradient.
+        """
+        self.sparse_traces.advance(steps)
+        self.sparse_traces.add(gradient.indices.numpy(), gradient.values.numpy())
+
+    def _update_kernel(self, scale):
+        """
+        Updates the rows of the first kernel that have a live sparse trace with scale * trace, like SGD would.
+        """
+        rows, traces = self.sparse_traces.current()
+        if len(rows):
+            self.model.trainable_weights[0].value.scatter_sub(
+                tf.IndexedSlices(self.learning_rate * scale * traces, rows))
+
+    def fit_batch(self, state_tensor, td_weights, trace_weights, carry, trace_decay):
+        """
+        Applies the updates of a window of steps at once (see BaseCritic.train_batch):
+        the weights are updated with carry * e + grad sum_j td_weights[j] V(s_j) as the gradient,
+        and the eligibilities become trace_decay * e + grad sum_j trace_weights[j] V(s_j).
+        """
+        args = (tf.convert_to_tensor(state_tensor, dtype=tf.float32), tf.cast(td_weights, tf.float32),
+                tf.cast(trace_weights, tf.float32), tf.constant(carry, tf.float32),
+                tf.constant(trace_decay, tf.float32))
+        if self.fused:
+            kernel_gradients = self._fused_fit_batch(*args)
+            if self.sparse_traces is not None:
+                self._update_kernel_batch(*kernel_gradients, carry, len(td_weights))
+            return self.model
+
+        params = self.model.trainable_weights
+        td_grads, trace_grads = self._weighted_gradients(*args[:3])
+        if self.sparse_traces is not None:
+            self._update_kernel_batch(td_grads[0], trace_grads[0], carry, len(td_weights))
+            params, td_grads, trace_grads = params[1:], td_grads[1:], trace_grads[1:]
+        if len(self.eligs) == 0:
+            self.eligs = [np.zeros(param.shape, dtype=np.float32) for param in params]
+        self.model.optimizer.apply_gradients(
+            zip([self._add_gradient(np.float32(carry) * elig, grad) for elig, grad in zip(self.eligs, td_grads)],
+                params))
+        self.eligs = [self._add_gradient(np.float32(trace_decay) * elig, grad)
+                      for elig, grad in zip(self.eligs, trace_grads)]
+        return self.model
+
+    def _weighted_gradients(self, state_tensor, td_weights, trace_weights):
+        """
+        Returns the gradients of sum_j td_weights[j] V(s_j) and of sum_j trace_weights[j] V(s_j),
+        from one forward pass. The gradients of an embedding-gather kernel stay tf.IndexedSlices.
+        """
+        params = self.model.trainable_weights
+        with tf.GradientTape(persistent=True) as tape:
+            values = self.model(state_tensor)[:, 0]
+            td_sum = tf.reduce_sum(values * td_weights)
+            trace_sum = tf.reduce_sum(values * trace_weights)
+        td_grads = tape.gradient(td_sum, params)
+        trace_grads = tape.gradient(trace_sum, params)
+        del tape
+        return td_grads, trace_grads
+
+    def _update_kernel_batch(self, td_gradient, trace_gradient, carry, steps):
+        """
+        fit_batch for the first kernel with sparse_traces: carry * e_in on the rows with a live trace plus the
+        td-weighted gradient rows, then e = decay ** steps * e_in (lazily) + the trace-weighted gradient rows.
+        """
+        self._update_kernel(carry)
+        self.model.trainable_weights[0].value.scatter_sub(
+            tf.IndexedSlices(self.learning_rate * td_gradient.values, td_gradient.indices))
+        self._add_kernel_gradient(trace_gradient, steps)
+
+    def _fused_batch_step(self, state_tensor, td_weights, trace_weights, carry, trace_decay):
+        """
+        With sparse_traces the first kernel is left out, and its (td, trace) gradients are returned.
+        """
+        sparse = self.sparse_traces is not None
+        td_grads, trace_grads = self._weighted_gradients(state_tensor, td_weights, trace_weights)
+        self.model.optimizer.apply_gradients(
+            zip([self._plus_gradient(carry * elig, grad) for elig, grad in zip(self.elig_vars, td_grads[sparse:])],
+                self._dense_trace_params()))
+        for elig, grad in zip(self.elig_vars, trace_grads[sparse:]):
+            elig.assign(self._plus_gradient(trace_decay * elig, grad))
+        if sparse:
+            return td_grads[0], trace_grads[0]
+
+    def _fused_step(self, state_tensor, td_error):
+        """
+        One training step with e = e + grad, update with e * td_error and e = discount_factor*eli_decay*e,
+        all performed in place on the eligibility variables.
+        With sparse_traces the first kernel is left out, and its gradient is returned.
+        """
+        with tf.GradientTape() as tape:
+            prediction = self.model(state_tensor)
+        gradients = tape.gradient(prediction, self.model.trainable_weights)
+        kernel_gradient = None
+        if self.sparse_traces is not None:
+            kernel_gradient, gradients = gradients[0], gradients[1:]
+        params = self._dense_trace_params()
+        for elig, gradient in zip(self.elig_vars, gradients):
+            if isinstance(gradient, tf.IndexedSlices):
+                # Gradient of an embedding gather, only the gathered rows
+                elig.scatter_add(gradient)
+            else:
+                elig.assign_add(gradient)
+        self.model.optimizer.apply_gradients(
+            zip([elig * td_error for elig in self.elig_vars], params))
+        for elig in self.elig_vars:
+            elig.assign(elig * (self.discount_factor * self.eli_decay))
+        return kernel_gradient
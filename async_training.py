@@ -0,0 +1,211 @@
+"""
+Asynchronous actor-learner training with several worker processes.
+
+Every worker plays episodes in its own Environment with a local Actor and critic, trained by main.play_episode
+like in main.train. After sync_interval episodes it sends the rows of the policy table and the critic weights it
+changed, with their changes, to the learner. The learner adds them to the shared parameters and sends back the rows
+that changed since that worker's last sync, together with the number of episodes to play next. The learner hands
+out exactly Training.number_of_episodes episodes in total.
+A message holds only changed rows, but the critic's dense layers usually change in every row, so with those the
+critic part of every message is still as large as its weights. Both ends also scan their whole tables once per sync
+to find the changed rows, in memory.
+Checkpoints, evaluation, value maps, the transition recorder and instrumentation are only supported with one worker.
+
+Enabled with Training.workers > 1, or from the project root:
+    python main.py --workers 4 --headless
+"""
+import multiprocessing
+import queue
+import numpy as np
+from agent.actor import Actor
+from agent.base_critic import create_critic
+from environment.coarsecoder import pack_state_keys, unpack_state_keys
+from environment.environment import Environment
+from runner import single_threaded_workers
+
+# Training options that need a single training loop
+UNSUPPORTED_OPTIONS = ("checkpoint", "evaluation", "value_map", "transitions_dir", "instrumentation")
+
+
+def _changed_rows(delta):
+    """
+    Returns the rows (along the first axis) in which a change to a parameter array is non-zero, and their changes.
+    """
+    rows = np.flatnonzero(np.any(delta.reshape(len(delta), -1) != 0, axis=1))
+    return rows, delta[rows]
+
+
+def _shared_parameters(actor, weights, policy_versions, weight_versions, since, episodes):
+    """
+    The message the learner sends to a worker: the policy rows and critic weight rows that changed after version
+    since (all of them for a new worker, since -1), and the episodes to play.
+    :param policy_versions: numpy array, version of the last change of every policy row
+    :param weight_versions: list of numpy arrays, version of the last change of every row of every weight array
+    """
+    rows = np.flatnonzero(policy_versions > since)
+    keys, key_format = pack_state_keys([actor.state_keys[row] for row in rows])
+    weight_rows = []
+    for weight, versions in zip(weights, weight_versions):
+        changed = np.flatnonzero(versions > since)
+        weight_rows.append((changed, weight[changed]))
+    return {"keys": keys, "key_format": key_format, "policy": actor.policy_table[rows], "weight_rows": weight_rows,
+            "episodes": episodes}
+
+
+def _worker(index, config, offsets, seed, updates, parameters):
+    """
+    Plays the episodes the learner asks for and sends back the rows it changed, until it gets None.
+    :param index: int, worker number
+    :param offsets: numpy array, tile offsets of the learner's tile coder (state keys depend on them)
+    :param seed: int or None, this worker's seed
+    :param updates: queue to the learner
+    :param parameters: queue from the learner to this worker
+    """
+    from main import play_episode
+    if seed is not None:
+        from main import seed_everything
+        seed_everything(seed, config)
+    env = Environment(config["Environment"])
+    env.coarse_code.offsets = offsets
+    critic = create_critic(config["Critic"], env.coarse_code.n_features)
+    actor = Actor(config["Actor"])
+    update_window = config["Critic"].get("update_window", 1)
+    while True:
+        message = parameters.get()
+        if message is None:
+            return
+        # Rows the message leaves out are the same here and in the learner,
+        # epsilon is the worker's own, it keeps decaying over the worker's episodes
+        actor.set_policy(unpack_state_keys(message["keys"], message["key_format"]), message["policy"])
+        weights = critic.get_weights()
+        for weight, (rows, values) in zip(weights, message["weight_rows"]):
+            weight[rows] = values
+        critic.set_weights(weights)
+        base_policy = actor.policy_table[:actor.n_states].copy()
+        base_weights = critic.get_weights()
+        steps = [play_episode(env, actor, critic, update_window) for _ in range(message["episodes"])]
+
+        policy = actor.policy_table[:actor.n_states].copy()
+        policy[:len(base_policy)] -= base_policy
+        changed, policy_delta = _changed_rows(policy)
+        keys, key_format = pack_state_keys([actor.state_keys[row] for row in changed])
+        weight_deltas = [_changed_rows(w - w0) for w, w0 in zip(critic.get_weights(), base_weights)]
+        updates.put((index, keys, key_format, policy_delta, weight_deltas, steps, actor.epsilon))
+
+
+def train_async(config, seed=None, headless=False, timeout=None):
+    """
+    Trains with Training.workers worker processes that sync with the learner every Training.sync_interval episodes.
+    :param config: dict
+    :param seed: int (optional, worker i is seeded with seed + i + 1)
+    :param headless: bool, no progress bar
+    :param timeout: float, seconds to wait for a worker update before giving up (optional)
+    :return: (env, actor, critic, steps_per_episode) like main.train, with the shared actor and critic,
+             and the steps of the episodes in the order the learner received them.
+             The actor's epsilon is the mean of the epsilons the workers last reported.
+    """
+    if seed is not None:
+        from main import seed_everything
+        seed_everything(seed, config)
+    if config["Environment"].get("hash_size"):
+        raise ValueError("Workers would each fill their own tile hash table, use hash_size: null with workers")
+    training_cfg = config["Training"]
+    unsupported = [name for name in UNSUPPORTED_OPTIONS if training_cfg.get(name)]
+    if unsupported:
+        raise ValueError("Training.{} is not supported with workers > 1".format(", Training.".join(unsupported)))
+    n_workers = training_cfg.get("workers", 1)
+    sync_interval = training_cfg.get("sync_interval", 1)
+    remaining = training_cfg["number_of_episodes"]
+
+    env = Environment(config["Environment"])
+    critic = create_critic(config["Critic"], env.coarse_code.n_features)
+    actor = Actor(config["Actor"])
+    weights = critic.get_weights()
+    steps_per_episode = []
+    # Every update from a worker is a new version, a worker gets the rows changed after the version it last got
+    version = 0
+    policy_versions = np.zeros(0, dtype=np.int64)
+    weight_versions = [np.zeros(len(weight), dtype=np.int64) for weight in weights]
+    synced = [-1] * n_workers
+
+    context = multiprocessing.get_context("spawn")
+    updates = context.Queue()
+    parameter_queues = [context.Queue() for _ in range(n_workers)]
+    processes = [context.Process(target=_worker, daemon=True,
+                                 args=(i, config, env.coarse_code.offsets, None if seed is None else seed + i + 1,
+                                       updates, parameter_queues[i]))
+                 for i in range(n_workers)]
+    with single_threaded_workers():
+        for process in processes:
+            process.start()
+
+    progress = None
+    if not headless:
+        from tqdm import tqdm  # Progressbar
+        progress = tqdm(total=remaining, desc=f"Playing {remaining} episodes with {n_workers} workers",
+                        colour='#39ff14')
+    try:
+        busy = 0
+        epsilons = {}
+        for i, parameter_queue in enumerate(parameter_queues):
+            episodes = min(sync_interval, remaining)
+            remaining -= episodes
+            if episodes:
+                parameter_queue.put(_shared_parameters(actor, weights, policy_versions, weight_versions, synced[i],
+                                                       episodes))
+                synced[i] = version
+                busy += 1
+            else:
+                parameter_queue.put(None)
+        while busy:
+            index, keys, key_format, policy_delta, weight_deltas, steps, epsilons[index] = _next_update(
+                updates, processes, timeout)
+            actor.epsilon = float(np.mean(list(epsilons.values())))
+            version += 1
+            rows = actor.add_to_policy(unpack_state_keys(keys, key_format), policy_delta)
+            if len(policy_versions) < actor.n_states:
+                policy_versions = np.concatenate(
+                    (policy_versions, np.zeros(actor.n_states - len(policy_versions), dtype=np.int64)))
+            policy_versions[rows] = version
+            for weight, versions, (changed, delta) in zip(weights, weight_versions, weight_deltas):
+                weight[changed] += delta
+                versions[changed] = version
+            steps_per_episode.extend(steps)
+            if progress is not None:
+                progress.update(len(steps))
+            episodes = min(sync_interval, remaining)
+            remaining -= episodes
+            if episodes:
+                parameter_queues[index].put(_shared_parameters(actor, weights, policy_versions, weight_versions,
+                                                               synced[index], episodes))
+                synced[index] = version
+            else:
+                parameter_queues[index].put(None)
+                busy -= 1
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        if progress is not None:
+            progress.close()
+    critic.set_weights(weights)
+    return env, actor, critic, steps_per_episode
+
+
+def _next_update(updates, processes, timeout):
+    """
+    Waits for the next worker update, raising if a worker died or nothing arrived within timeout seconds.
+    """
+    waited = 0.0
+    while True:
+        try:
+            return updates.get(timeout=1.0)
+        except queue.Empty:
+            waited += 1.0
+            dead = [process for process in processes if process.exitcode not in (None, 0)]
+            if dead:
+                raise RuntimeError("Worker process exited with code {}".format(dead[0].exitcode))
+            if timeout is not None and waited >= timeout:
+                raise TimeoutError("No worker update within {} s".format(timeout))
@@ -0,0 +1,53 @@
+"""
+Runs the encoder, actor, critic, batched critic update, episode and cold-start benchmarks and writes the results
+with machine info as json.
+With --compare, results are checked against a baseline json file and regressions are flagged.
+
+Example, from the project root:
+    python -m benchmarks --output bench.json
+    python -m benchmarks --compare bench.json --threshold 0.2
+"""
+import argparse
+import sys
+from benchmarks import actor, batch_update, critic, encoder, episodes, startup
+from benchmarks.timing import compare, load, save
+
+SUITES = {"encoder": encoder, "actor": actor, "critic": critic, "batch_update": batch_update, "episodes": episodes,
+          "startup": startup}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=sorted(SUITES), default=list(SUITES))
+    parser.add_argument("--quick", action="store_true", help="fewer calls per benchmark")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", metavar="BASELINE", help="json file written by an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="flag benchmarks more than this fraction slower than the baseline")
+    args = parser.parse_args()
+
+    # Read before the run, --output may overwrite the baseline file
+    baseline = load(args.compare) if args.compare else None
+    results = []
+    for name in args.only:
+        for r in SUITES[name].run(quick=args.quick):
+            print("{:<40} {:>12.2f} us/call".format(r["name"], r["us_per_call"]))
+            if r["params"].get("within_target") is False:
+                print("{:<40} above the {} s target".format("", r["params"]["target_s"]))
+            results.append(r)
+    save(args.output, results)
+    print("saved to", args.output)
+
+    if baseline is not None:
+        rows = compare(results, baseline, args.threshold)
+        regressions = [row for row in rows if row[4]]
+        for name, old, new, ratio, regressed in rows:
+            print("{:<40} {:>10.2f} -> {:>10.2f} us  x{:.2f}{}".format(
+                name, old, new, ratio, "  REGRESSION" if regressed else ""))
+        if regressions:
+            print("{} regression(s) above {:.0%}".format(len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import random
+from agent.actor import Actor
+from benchmarks.timing import time_calls, result
+
+ACTOR_CONFIG = {"epsilon": 0.1, "epsilon_decay": 1, "discount_factor": 0.9, "eli_decay": 0.85,
+                "learning_rate": 0.1, "trace_cutoff": 1e-4}
+
+
+def run(quick=False):
+    """
+    Times Actor.get_action and Actor.step_update on tables of growing size.
+    """
+    calls = 500 if quick else 5000
+    results = []
+    for n_states in (100, 1000, 10000, 100000):
+        random.seed(0)
+        actor = Actor(ACTOR_CONFIG)
+        states = [(i, n_states + i) for i in range(n_states)]
+        for state in states:
+            actor.step_update(state, 1, 0.0)
+        actor.reset_eli_dict()
+        picks = [random.choice(states) for _ in range(calls * 4)]
+        it = iter(picks)
+        results.append(result("actor.get_action.n{}".format(n_states),
+                              time_calls(lambda: actor.get_action(next(it), [1, 0, -1]), calls),
+                              n_states=n_states))
+        it = iter(picks)
+        results.append(result("actor.step_update.n{}".format(n_states),
+                              time_calls(lambda: actor.step_update(next(it), 1, 0.5), calls),
+                              n_states=n_states))
+    return results
@@ -0,0 +1,79 @@
+import random
+import time
+import numpy as np
+from agent.base_critic import create_critic
+from environment.coarsecoder import TileEncoder
+from benchmarks.timing import result
+
+ENV_CONFIG = {"pos_range": (-1.21, 0.61), "velocity_range": (-0.071, 0.071), "granularity": [4, 4]}
+# The batched update is checked against the per-step one in tests/test_batch_update.py, this only times them
+CRITIC_CONFIG = {"learning_rate": 0.0001, "discount_factor": 0.99, "eli_decay": 0.85, "track_studied": False,
+                 "fused_update": True, "internal_dims": [16], "seed": 0}
+
+
+def trajectory(steps):
+    """
+    States of a car driven by random actions, and random rewards.
+    """
+    random.seed(0)
+    encoder = TileEncoder(ENV_CONFIG)
+    position, velocity = -0.5, 0.0
+    states = []
+    for _ in range(steps + 1):
+        states.append(encoder.get_active_features(position, velocity))
+        velocity = min(max(velocity + 0.001 * random.choice([1, 0, -1]) - 0.0025 * np.cos(3 * position),
+                           -0.07), 0.07)
+        position = min(max(position + velocity, -1.2), 0.6)
+    return states, [random.uniform(-1, 1) for _ in range(steps)]
+
+
+def train(backend, initial, states, rewards, window):
+    """
+    Trains a critic starting from the initial weights on the trajectory, per step (window 1) or in windows.
+    :return: seconds per step
+    """
+    critic = create_critic(dict(CRITIC_CONFIG, backend=backend), len(initial[0]))
+    # Warm up (traces the tf.functions), then start from the same weights as every other run
+    critic.train(states[0], 0.0)
+    critic.train_batch(states[:2], [0.0, 0.0])
+    critic.set_weights(initial)
+    critic.reset_eli_dict()
+    start = time.perf_counter()
+    if window == 1:
+        for i in range(len(rewards)):
+            td_err = critic.compute_td_err(states[i], states[i + 1], rewards[i])
+            critic.train(states[i], td_err)
+            critic.update_eligs()
+    else:
+        for first in range(0, len(rewards), window):
+            last = min(first + window, len(rewards))
+            td_errs = critic.compute_td_errs(states[first:last + 1], rewards[first:last])
+            critic.train_batch(states[first:last], td_errs)
+    return (time.perf_counter() - start) / len(rewards)
+
+
+def run(quick=False, backends=("numpy", "keras"), windows=(8, 32)):
+    """
+    Times per-step and batched critic training on the same trajectory.
+    """
+    states, rewards = trajectory(128 if quick else 512)
+    # Both backends have the same layout, the seeded numpy initialisation is used for all runs
+    n_features = TileEncoder(ENV_CONFIG).n_features
+    initial = create_critic(dict(CRITIC_CONFIG, backend="numpy"), n_features).get_weights()
+    results = []
+    for backend in backends:
+        try:
+            seconds = train(backend, initial, states, rewards, 1)
+        except ImportError:
+            continue
+        results.append(result("batch_update.{}.window1".format(backend), seconds, backend=backend))
+        for window in windows:
+            seconds = train(backend, initial, states, rewards, window)
+            results.append(result("batch_update.{}.window{}".format(backend, window), seconds, backend=backend))
+    return results
+
+
+if __name__ == '__main__':
+    for r in run():
+        print("{:<36} {:>10.2f} us/step  {}".format(r["name"], r["us_per_call"], {
+            key: value for key, value in r["params"].items() if key != "backend"}))
@@ -0,0 +1,42 @@
+import random
+from agent.base_critic import create_critic
+from environment.coarsecoder import TileEncoder
+from benchmarks.timing import time_calls, result
+
+ENV_CONFIG = {"pos_range": (-1.21, 0.61), "velocity_range": (-0.071, 0.071), "granularity": [4, 4]}
+CRITIC_CONFIG = {"learning_rate": 0.01, "discount_factor": 0.99, "eli_decay": 0.85, "track_studied": False,
+                 "fused_update": True, "seed": 0}
+
+
+def run(quick=False, backends=("numpy", "keras")):
+    """
+    Times one critic step (compute_td_err + train + update_eligs) for several internal_dims and backends.
+    The keras backend is skipped when tensorflow is not installed.
+    """
+    calls = 50 if quick else 500
+    random.seed(0)
+    encoder = TileEncoder(ENV_CONFIG)
+    states = [encoder.get_active_features(random.uniform(-1.2, 0.6), random.uniform(-0.07, 0.07))
+              for _ in range(calls * 4 + 1)]
+    results = []
+    for backend in backends:
+        for internal_dims in (0, [16], [64, 64]):
+            try:
+                critic = create_critic(dict(CRITIC_CONFIG, backend=backend, internal_dims=internal_dims),
+                                       encoder.n_features)
+            except ImportError:
+                break
+            it = iter(range(len(states) - 1))
+
+            def step():
+                i = next(it)
+                td_err = critic.compute_td_err(states[i], states[i + 1], 0)
+                critic.train(states[i], td_err)
+                critic.update_eligs()
+            # Warm up, the first keras step traces the fused tf.function
+            step()
+            name = "critic.{}.dims{}".format(
+                backend, "-".join(str(d) for d in internal_dims) if internal_dims else 0)
+            results.append(result(name, time_calls(step, calls), backend=backend,
+                                  internal_dims=internal_dims))
+    return results
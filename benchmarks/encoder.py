@@ -0,0 +1,40 @@
+import random
+from environment.coarsecoder import CoarseCoder, TileEncoder
+from benchmarks.timing import time_calls, result
+
+POS_RANGE = (-1.21, 0.61)
+VELOCITY_RANGE = (-0.071, 0.071)
+
+
+def run(quick=False):
+    """
+    Times TileEncoder and CoarseCoder encodings of one state for several granularities,
+    and sparse encodings with many evenly spread tilings, with and without hashing.
+    """
+    calls = 200 if quick else 2000
+    random.seed(0)
+    states = [(random.uniform(-1.2, 0.6), random.uniform(-0.07, 0.07)) for _ in range(calls)]
+    results = []
+    for g in (4, 8, 16, 32, 64):
+        config = {"pos_range": POS_RANGE, "velocity_range": VELOCITY_RANGE, "granularity": [g, g],
+                  # Overlaps must stay below the bucket width, a quarter of it works for every granularity
+                  "pos_overlap": (POS_RANGE[1] - POS_RANGE[0]) / g / 4,
+                  "velocity_overlap": (VELOCITY_RANGE[1] - VELOCITY_RANGE[0]) / g / 4}
+        encoder = TileEncoder(config)
+        coarse = CoarseCoder(config, POS_RANGE, VELOCITY_RANGE)
+        for name, encode in (("tile_encoder.dense", encoder.get_coarse_encoding),
+                             ("tile_encoder.sparse", encoder.get_active_features),
+                             ("coarse_coder.dense", coarse.get_coarse_encoding)):
+            it = iter(states * 4)
+            results.append(result("{}.g{}".format(name, g),
+                                  time_calls(lambda: encode(*next(it)), calls),
+                                  granularity=g))
+    for n_tilings, g, hash_size in ((16, 16, None), (64, 32, None), (64, 32, 4096)):
+        encoder = TileEncoder({"pos_range": POS_RANGE, "velocity_range": VELOCITY_RANGE, "granularity": [g, g],
+                               "n_tilings": n_tilings, "tile_offsets": "even", "tile_seed": 0,
+                               "hash_size": hash_size})
+        it = iter(states * 4)
+        results.append(result("tile_encoder.sparse.t{}.g{}{}".format(n_tilings, g, ".hashed" if hash_size else ""),
+                              time_calls(lambda: encoder.get_active_features(*next(it)), calls),
+                              granularity=g, n_tilings=n_tilings, hash_size=hash_size))
+    return results
@@ -0,0 +1,30 @@
+import time
+from benchmarks.timing import result
+
+STEP_BUDGET = 300
+
+
+def run(quick=False, backends=("numpy", "keras")):
+    """
+    Times whole training episodes with a fixed seed and a fixed step budget (max_steps), using main.play_episode.
+    The agent is built and warmed up by a one-episode main.train first, so building the environment, critic and
+    actor and compiling the fused step are not part of the timing.
+    """
+    from main import load_config, play_episode, train
+    episodes = 2 if quick else 5
+    results = []
+    for backend in backends:
+        config = load_config(overrides=["Critic.backend={}".format(backend),
+                                        "Environment.max_steps={}".format(STEP_BUDGET),
+                                        "Training.number_of_episodes=1"])
+        try:
+            env, actor, critic, _ = train(config, seed=0, headless=True)
+        except ImportError:
+            continue
+        update_window = config["Critic"].get("update_window", 1)
+        start = time.perf_counter()
+        steps = sum(play_episode(env, actor, critic, update_window) for _ in range(episodes))
+        seconds = time.perf_counter() - start
+        results.append(result("episodes.{}".format(backend), seconds / episodes, backend=backend,
+                              step_budget=STEP_BUDGET, steps_per_s=steps / seconds))
+    return results
@@ -0,0 +1,49 @@
+"""
+Compares critic training steps per second with the eager SplitGD and the fused tf.function step.
+Run from the project root: python -m benchmarks.split_gd
+"""
+import argparse
+import random
+import time
+import yaml
+from agent.critic import Critic
+from environment.coarsecoder import TileEncoder
+
+
+def steps_per_second(critic_cfg, env_cfg, steps, fused):
+    """
+    Times compute_td_err + train + update_eligs on random states, the way main() calls them every step.
+    :param critic_cfg: dict
+    :param env_cfg: dict
+    :param steps: int
+    :param fused: bool
+    """
+    random.seed(0)
+    encoder = TileEncoder(env_cfg)
+    critic = Critic(dict(critic_cfg, fused_update=fused), encoder.n_features)
+    states = [encoder.get_active_features(random.uniform(-1.2, 0.6), random.uniform(-0.07, 0.07))
+              for _ in range(steps + 1)]
+    # The first step includes tracing the tf.function, keep it out of the timing
+    critic.train(states[0], critic.compute_td_err(states[0], states[1], 0))
+    start = time.perf_counter()
+    for i in range(steps):
+        td_err = critic.compute_td_err(states[i], states[i + 1], 0)
+        critic.train(state=states[i], td_error=td_err)
+        critic.update_eligs()
+    return steps / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", default="configs/config.yml")
+    parser.add_argument("--steps", type=int, default=500)
+    args = parser.parse_args()
+    config = yaml.full_load(open(args.config))
+    for fused in (False, True):
+        rate = steps_per_second(
+            config["Critic"], config["Environment"], args.steps, fused)
+        print(f"{'fused' if fused else 'eager'}: {rate:.1f} steps/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+import time
+from benchmarks.timing import result
+
+# Target for a headless numpy-backend worker to import everything and finish a run without episodes
+COLD_START_TARGET_S = 1.0
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def cold_start(command, repeat):
+    """
+    Runs command in a fresh python process repeat times and returns the fastest wall time in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, cwd=ROOT, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(quick=False):
+    """
+    Times a cold `import main` and a cold headless run of zero episodes with the numpy critic.
+    """
+    repeat = 2 if quick else 5
+    results = [result("startup.import_main", cold_start(["-c", "import main"], repeat))]
+    seconds = cold_start(["main.py", "--headless", "--episodes", "0", "--set", "Critic.backend=numpy"], repeat)
+    results.append(result("startup.headless_numpy", seconds, target_s=COLD_START_TARGET_S,
+                          within_target=seconds <= COLD_START_TARGET_S))
+    return results
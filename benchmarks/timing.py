@@ -0,0 +1,72 @@
+import json
+import os
+import platform
+import sys
+import time
+
+
+def time_calls(function, calls, repeat=3):
+    """
+    Times function() called calls times in a row, repeat times, and keeps the fastest round.
+    :param function: callable without arguments
+    :param calls: int
+    :param repeat: int
+    :return: seconds per call
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        best = min(best, time.perf_counter() - start)
+    return best / calls
+
+
+def result(name, seconds_per_call, **params):
+    """
+    One benchmark result, keyed on name in the json file.
+    """
+    return {"name": name, "us_per_call": seconds_per_call * 1e6, "calls_per_s": 1 / seconds_per_call,
+            "params": params}
+
+
+def machine_info():
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {"python": sys.version.split()[0], "platform": platform.platform(), "processor": platform.processor(),
+            "machine": platform.machine(), "cpu_count": os.cpu_count(), "numpy": numpy_version,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def save(path, results):
+    with open(path, "w") as file:
+        json.dump({"machine": machine_info(), "results": {r["name"]: r for r in results}}, file, indent=2)
+
+
+def load(path):
+    """
+    Reads the results of a json file written by save(), keyed on name.
+    """
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares results with a saved baseline.
+    :param results: list of results
+    :param baseline: dict of baseline results keyed on name, see load()
+    :param threshold: float, a benchmark regressed if it is more than this fraction slower than the baseline
+    :return: list of (name, baseline us_per_call, us_per_call, ratio, regressed)
+    """
+    rows = []
+    for r in results:
+        if r["name"] not in baseline:
+            continue
+        old = baseline[r["name"]]["us_per_call"]
+        ratio = r["us_per_call"] / old
+        rows.append((r["name"], old, r["us_per_call"], ratio, ratio > 1 + threshold))
+    return rows
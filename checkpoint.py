@@ -0,0 +1,112 @@
+"""
+Checkpoints of the full training state: actor tables, critic weights and seen states, epsilon, the tile offsets
+and hash table, the steps per episode so far and the python/numpy random generator states.
+
+A checkpoint is one uncompressed .npz of plain arrays (no pickling), written to a temporary file and renamed over
+the previous checkpoint, so a crash while writing never leaves a broken checkpoint behind.
+"""
+import os
+import random
+import signal
+import numpy as np
+from environment.coarsecoder import pack_state_keys, unpack_state_keys
+
+CHECKPOINT_FILE = "checkpoint.npz"
+
+
+def save_checkpoint(directory, episode, env, actor, critic, steps_per_episode):
+    """
+    Atomically writes <directory>/checkpoint.npz.
+    :param episode: int, the next episode to run when resuming
+    :return: the path of the checkpoint
+    """
+    arrays = {"actor_" + name: value for name,
+              value in actor.get_tables().items()}
+    weights = critic.get_weights()
+    arrays.update({"critic_weight_{}".format(i): w for i, w in enumerate(weights)})
+    studied, studied_format = pack_state_keys(critic.studied)
+    arrays.update(critic_n_weights=len(weights), critic_studied=studied, critic_studied_format=studied_format,
+                  critic_n_studied=critic.n_studied, critic_track_studied=critic.track_studied,
+                  epsilon=actor.epsilon, tile_offsets=env.coarse_code.offsets, episode=episode,
+                  steps_per_episode=np.array(steps_per_episode, dtype=np.int64))
+    if env.coarse_code.iht is not None:
+        iht = env.coarse_code.iht.get_state()
+        arrays.update(tile_hash_tiles=iht["tiles"], tile_hash_overflow_count=iht["overflow_count"])
+
+    version, python_state, gauss_next = random.getstate()
+    arrays.update(python_random_version=version, python_random_state=np.array(python_state, dtype=np.int64),
+                  python_random_gauss=np.nan if gauss_next is None else gauss_next)
+    _, numpy_keys, numpy_pos, numpy_has_gauss, numpy_gauss = np.random.get_state()
+    arrays.update(numpy_random_keys=numpy_keys, numpy_random_pos=numpy_pos,
+                  numpy_random_has_gauss=numpy_has_gauss, numpy_random_gauss=numpy_gauss)
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, CHECKPOINT_FILE)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        np.savez(file, **arrays)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    return path
+
+
+def load_checkpoint(directory):
+    """
+    Reads <directory>/checkpoint.npz.
+    :return: dict of numpy arrays, or None if there is no checkpoint
+    """
+    path = os.path.join(directory, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def restore_checkpoint(checkpoint, env, actor, critic):
+    """
+    Puts the state of a loaded checkpoint back into freshly created objects, and restores the random generators.
+    :return: (next episode to run, steps_per_episode so far)
+    """
+    env.coarse_code.offsets = checkpoint["tile_offsets"]
+    if "tile_hash_tiles" in checkpoint:
+        env.coarse_code.iht.set_state(checkpoint["tile_hash_tiles"], checkpoint["tile_hash_overflow_count"])
+    actor.set_tables({name[len("actor_"):]: value for name, value in checkpoint.items()
+                      if name.startswith("actor_")})
+    actor.epsilon = float(checkpoint["epsilon"])
+    critic.set_weights([checkpoint["critic_weight_{}".format(i)]
+                        for i in range(int(checkpoint["critic_n_weights"]))])
+    critic.studied = set(unpack_state_keys(checkpoint["critic_studied"],
+                                           str(checkpoint["critic_studied_format"])))
+    critic.n_studied = int(checkpoint["critic_n_studied"])
+    critic.track_studied = bool(checkpoint["critic_track_studied"])
+
+    gauss_next = float(checkpoint["python_random_gauss"])
+    random.setstate((int(checkpoint["python_random_version"]),
+                     tuple(checkpoint["python_random_state"].tolist()),
+                     None if np.isnan(gauss_next) else gauss_next))
+    np.random.set_state(("MT19937", checkpoint["numpy_random_keys"], int(checkpoint["numpy_random_pos"]),
+                         int(checkpoint["numpy_random_has_gauss"]), float(checkpoint["numpy_random_gauss"])))
+    return int(checkpoint["episode"]), checkpoint["steps_per_episode"].tolist()
+
+
+class TerminationFlag:
+    """
+    Catches SIGTERM so training can checkpoint and stop after the current episode instead of dying mid-way.
+    """
+
+    def __init__(self):
+        self.requested = False
+        self._previous = None
+        try:
+            self._previous = signal.signal(signal.SIGTERM, self._handle)
+        except ValueError:
+            # Signal handlers can only be installed from the main thread
+            pass
+
+    def _handle(self, signum, frame):
+        self.requested = True
+
+    def restore(self):
+        if self._previous is not None:
+            signal.signal(signal.SIGTERM, self._previous)
@@ -1,7 +1,45 @@
-import numpy as np
-import pandas as pd
+from contextlib import contextmanager
 from random import random
-from copy import deepcopy
+import numpy as np
+
+
+def state_key(state):
+    """
+    Returns a hashable key for an encoded state.
+    Sparse states (tuples of active feature indices) and strings are used as they are,
+    numpy arrays are keyed on their raw bytes.
+    :param state: tuple(int) or numpy array
+    """
+    if isinstance(state, (tuple, str)):
+        return state
+    return np.ascontiguousarray(state).tobytes()
+
+
+def pack_state_keys(keys):
+    """
+    Packs a list of state keys into a numpy array, tuples as rows of ints and bytes as rows of uint8.
+    :param keys: list of keys returned by state_key (all of the same kind)
+    :return: (array, key format) where the format is 'tuple', 'bytes' or 'str'
+    """
+    keys = list(keys)
+    if not keys:
+        return np.empty((0, 0), dtype=np.int64), "tuple"
+    if isinstance(keys[0], tuple):
+        return np.array(keys, dtype=np.int64).reshape(len(keys), -1), "tuple"
+    if isinstance(keys[0], bytes):
+        return np.frombuffer(b"".join(keys), dtype=np.uint8).reshape(len(keys), -1), "bytes"
+    return np.array(keys), "str"
+
+
+def unpack_state_keys(array, key_format):
+    """
+    Turns an array made by pack_state_keys back into a list of state keys.
+    """
+    if key_format == "tuple":
+        return [tuple(row) for row in array.tolist()]
+    if key_format == "bytes":
+        return [row.tobytes() for row in array]
+    return array.tolist()
 
 
 class CoarseCoder:
@@ -9,6 +47,7 @@ class CoarseCoder:
     def __init__(self, config, pos_range=(-1.2, 0.6), velocity_range=(-0.07, 0.07)):
         """
         Defines the parameters the encoder will use when encoding.
+        The bin edges are computed once here, and so is the check that the overlap fits inside a bucket.
         :param granularity: How many 'buckets' to sort each axis into as tuple (pos-granularity, vel-granularity)
         :param pos_overlap: The overlap between position buckets
         :param velocity_overlap: The overlap between velocity buckets
@@ -21,18 +60,6 @@ class CoarseCoder:
         self.velocity_range = velocity_range
         self.pos_range = pos_range
 
-    def get_coarse_encoding(self, pos, velocity):
-        """
-        Gets a coarse encoded numpy array for the supplied position and velocity
-        :param pos: The position
-        :param velocity: The velocity
-        :return: The coarse encoded numpy array
-        """
-        if self.pos_range[0] > pos > self.pos_range[1] or self.velocity_range[0] > velocity > self.velocity_range[1]:
-            raise AttributeError("Pos ({}) and velocity ({}) is outside ranges for coder, {} & {}".format(
-                pos, velocity, self.pos_range, self.velocity_range
-            ))
-
         # Raise error if overlap between buckets is larger than the range of the bucket
         range_pos = (
             abs(self.pos_range[0]-self.pos_range[1]))/self.granularity[0]
@@ -44,178 +71,266 @@ class CoarseCoder:
                 range_pos, range_vel, self.pos_overlap, self.velocity_overlap
             ))
 
-        coarse_array = self._create_empty_encoding_df()
-        for vel_bin, row in coarse_array.iterrows():
-            for pos_bin, val in row.iteritems():
-                if self._value_in_bin(velocity, vel_bin) and self._value_in_bin(pos, pos_bin):
-                    coarse_array.loc[[vel_bin], [pos_bin]] = 1
+        self.pos_starts, self.pos_ends = self._create_axis_edges(
+            self.pos_range, self.granularity[0], self.pos_overlap)
+        self.vel_starts, self.vel_ends = self._create_axis_edges(
+            self.velocity_range, self.granularity[1], self.velocity_overlap)
 
-        return coarse_array.to_numpy()
+    def get_coarse_encoding(self, pos, velocity):
+        """
+        Gets a coarse encoded numpy array for the supplied position and velocity.
+        Rows correspond to velocity bins and columns to position bins.
+        :param pos: The position
+        :param velocity: The velocity
+        :return: The coarse encoded numpy array
+        """
+        coarse_array = np.zeros(
+            (self.granularity[1], self.granularity[0]), dtype=int)
+        pos_first, pos_last = self._active_bins(
+            pos, self.pos_starts, self.pos_ends)
+        vel_first, vel_last = self._active_bins(
+            velocity, self.vel_starts, self.vel_ends)
+        coarse_array[vel_first:vel_last, pos_first:pos_last] = 1
+        return coarse_array
 
     @staticmethod
-    def _value_in_bin(val, b):
+    def _active_bins(val, starts, ends):
         """
-        Returns True if the value is in the bin, else False 
+        Returns the (first, last + 1) indices of the bins containing the value.
+        Both starts and ends are sorted, so the bins with start <= val <= end form one contiguous run.
         :param val: The value
-        :param b: The bin (start_val, end_val)
-        :return: True if value in bin, else False
-        """
-        return b[0] <= val <= b[1]
-
-    def _create_empty_encoding_df(self):
-        """
-        Creates a pandas data-frame (all zeros) to use for coarse encoding.
-        The rows and columns are assigned headers that correspond to the bins they are representing.
-        :return: The data-frame
-        """
-        encoding_array = []
-
-        # Create the bins for position
-        pos_starts = np.linspace(
-            self.pos_range[0], self.pos_range[1], self.granularity[0] + 1)[:-1]
-        pos_ends = np.array(np.linspace(self.pos_range[0], self.pos_range[1], self.granularity[0] + 1) +
-                            self.pos_overlap)[1:]
-        pos_bins = self._create_axis_bins(pos_starts, pos_ends)
-        # Create the bins for velocity
-        vel_starts = np.linspace(
-            self.velocity_range[0], self.velocity_range[1], self.granularity[1] + 1)[:-1]
-        vel_ends = np.array(np.linspace(self.velocity_range[0], self.velocity_range[1], self.granularity[1] + 1) +
-                            self.velocity_overlap)[1:]
-        vel_bins = self._create_axis_bins(vel_starts, vel_ends)
-
-        # Create the array with all zeros
-        for i in range(self.granularity[0]):
-            row = []
-            for j in range(self.granularity[1]):
-                row.append(0)
-            encoding_array.append(row)
-
-        df = pd.DataFrame(encoding_array, index=vel_bins, columns=pos_bins)
-        return df
+        :param starts: The starts of the bins
+        :param ends: The ends of the bins
+        :return: Tuple (first, stop) to slice the active bins with
+        """
+        return np.searchsorted(ends, val, side='left'), np.searchsorted(starts, val, side='right')
 
     @staticmethod
-    def _create_axis_bins(starts, ends):
+    def _create_axis_edges(value_range, granularity, overlap):
         """
-        Given the start and end of a list of bins, returns the ranges of all the bins.
-        :param starts: The starts of the bins
-        :param ends: The ends of the bins
-        :return: The ranges of all the bins
+        Creates the starts and ends of the bins along one axis. Each bin is stretched by the overlap.
+        :param value_range: The range of the axis (as tuple)
+        :param granularity: The number of bins
+        :param overlap: The overlap between neighbouring bins
+        :return: Tuple (starts, ends) as numpy arrays
+        """
+        edges = np.linspace(value_range[0], value_range[1], granularity + 1)
+        return edges[:-1], edges[1:] + overlap
+
+
+class IndexHashTable:
+    """
+    Index table of a fixed size in the style of Sutton's IHT: every new tile gets the next free feature index,
+    and once all size indices are taken, new tiles share indices by hashing (counted in overflow_count).
+    Memory is bounded by size, however fine the tilings are.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: int, number of feature indices
+        """
+        self.size = size
+        self.indices = {}
+        self.overflow_count = 0
+
+    def __len__(self):
+        return len(self.indices)
+
+    def index(self, tile):
         """
-        bins = []
-        for i in range(len(starts)):
-            bins.append((starts[i], ends[i]))
-        return bins
+        Returns the feature index of a tile, given as its unhashed feature number (-1 stays -1).
+        :param tile: int
+        """
+        index = self.indices.get(tile)
+        if index is not None:
+            return index
+        if tile < 0:
+            return -1
+        if len(self.indices) < self.size:
+            index = self.indices[tile] = len(self.indices)
+            return index
+        self.overflow_count += 1
+        # Knuth's multiplicative hash spreads neighbouring tiles over the table
+        return tile * 2654435761 % self.size
+
+    def index_batch(self, tiles):
+        """
+        Returns the feature indices of a numpy array of unhashed feature numbers, in the same shape.
+        """
+        return np.fromiter(map(self.index, tiles.ravel().tolist()), dtype=np.int64,
+                           count=tiles.size).reshape(tiles.shape)
+
+    def get_state(self):
+        """
+        Returns the table as numpy arrays, the tiles in the order they were added.
+        """
+        return {"tiles": np.fromiter(self.indices, dtype=np.int64, count=len(self.indices)),
+                "overflow_count": self.overflow_count}
+
+    def set_state(self, tiles, overflow_count=0):
+        self.indices = {tile: index for index, tile in enumerate(tiles.tolist())}
+        self.overflow_count = int(overflow_count)
 
 
 class TileEncoder:
 
     def __init__(self, config):
+        """
+        :param granularity: (position, velocity) number of tiles of a tiling along each axis
+        :param n_tilings: int (optional, default 5)
+        :param tile_offsets: 'random' (optional, default) for the original five tilings, a centred one and four
+            displaced by random fractions of a tile, or 'even' for n_tilings tilings displaced evenly along
+            (1, 3) with one extra tile per axis, so every tiling covers the whole range
+        :param tile_seed: int (optional, seeds the common shift of the 'even' tilings, which is otherwise drawn
+            from the global generator like the 'random' offsets)
+        :param hash_size: int (optional, map tiles to this many features with an IndexHashTable,
+            needs sparse_state: True in an Environment)
+        """
         self.pos_range = config['pos_range']
         self.velocity_range = config['velocity_range']
         self.granularity = config['granularity']
-        self.tiles = self._init_tiles()
+        self.tile_size = np.array([abs(self.pos_range[0] - self.pos_range[1]) / self.granularity[0],
+                                   abs(self.velocity_range[0] - self.velocity_range[1]) / self.granularity[1]])
+        self.n_tilings = config.get('n_tilings', 5)
+        self.tile_offsets = config.get('tile_offsets', 'random')
+        if self.tile_offsets == 'random':
+            if self.n_tilings != 5:
+                raise ValueError("tile_offsets: random makes exactly 5 tilings, use tile_offsets: even "
+                                 "for n_tilings: {}".format(self.n_tilings))
+            self.offsets = self._init_tiles()
+            # (position, velocity) number of tiles of every tiling
+            self.tiles = (self.granularity[0], self.granularity[1])
+        elif self.tile_offsets == 'even':
+            self.offsets = self._even_tiles(config.get('tile_seed'))
+            self.tiles = (self.granularity[0] + 1, self.granularity[1] + 1)
+        else:
+            raise ValueError(
+                "Unknown tile_offsets {}, expected 'random' or 'even'".format(self.tile_offsets))
+        self.tiling_size = self.tiles[0] * self.tiles[1]
+        self._tiling_starts = np.arange(self.n_tilings) * self.tiling_size
+        hash_size = config.get('hash_size')
+        self.iht = IndexHashTable(hash_size) if hash_size else None
+        # Width of the encoding, the input width of the critic
+        self.n_features = hash_size if hash_size else self.n_tilings * self.tiling_size
+
+    @contextmanager
+    def preserved_hash_table(self):
+        """
+        Tiles added to the hash table by encodings inside the block are taken out again afterwards, so encoding
+        states training has not visited (evaluation grids, policy export) does not fill the table.
+        Does nothing without hashing.
+        """
+        if self.iht is None:
+            yield
+            return
+        table = self.iht.get_state()
+        try:
+            yield
+        finally:
+            self.iht.set_state(table["tiles"], table["overflow_count"])
 
     def get_coarse_encoding(self, pos, vel):
-        encoding = []
-        for array in self.tiles:
-            coarse_array = deepcopy(array)
-            for vel_bin, row in coarse_array.iterrows():
-                for pos_bin, val in row.iteritems():
-                    if self._value_in_bin(vel, vel_bin) and self._value_in_bin(pos, pos_bin):
-                        coarse_array.loc[[vel_bin], [pos_bin]] = 1
-
-            encoding.append(coarse_array.to_numpy())
+        """
+        Gets the tile encoding for the supplied position and velocity.
+        Returns one (velocity tiles, position tiles) binary array per tiling,
+        with a single one in the cell containing the state (or none if the state is outside that tiling).
+        With hashing it is a flat binary array of hash_size features instead.
+        :param pos: The position
+        :param vel: The velocity
+        :return: numpy array of shape (n_tilings, tiles[1], tiles[0]), or (hash_size,) with hashing
+        """
+        return self.get_coarse_encoding_batch(np.array([pos]), np.array([vel]))[0]
 
-        return np.array(encoding)
+    def get_active_features(self, pos, vel):
+        """
+        Gets the sparse form of the tile encoding: the index of the active feature in every tiling,
+        using the same flat layout as get_coarse_encoding(pos, vel).flatten().
+        :param pos: The position
+        :param vel: The velocity
+        :return: Tuple with one feature index per tiling (-1 if the state is outside that tiling)
+        """
+        cells = self._active_cells(np.array([pos]), np.array([vel]))[0]
+        features = np.where(cells >= 0, cells + self._tiling_starts, -1).tolist()
+        if self.iht is not None:
+            return tuple(map(self.iht.index, features))
+        return tuple(features)
 
-    def _init_tiles(self):
-        """Create five tiles, four displaced from the one in the center"""
-        return_tiles = [self.create_empty_tile(
-            self.pos_range, self.velocity_range, self.granularity)]
-        tile_size = (abs(self.pos_range[0] - self.pos_range[1]) / self.granularity[0],
-                     abs(self.velocity_range[0] - self.velocity_range[1]) / self.granularity[1])
-        displacement_pos = random() * tile_size[0]
-        displacement_vel = random() * tile_size[1]
-        # Create tile move upwards right
-        return_tiles.append(self.create_empty_tile((self.pos_range[0] + displacement_pos, self.pos_range[1] + displacement_pos),
-                                                   (self.velocity_range[0] + displacement_vel,
-                                                    self.velocity_range[1] + displacement_vel),
-                                                   self.granularity))
-
-        displacement_pos = random() * tile_size[0]
-        displacement_vel = random() * tile_size[1]
-        # Create tile move upwards left
-        return_tiles.append(self.create_empty_tile((self.pos_range[0] + displacement_pos, self.pos_range[1] + displacement_pos),
-                                                   (self.velocity_range[0] - displacement_vel,
-                                                    self.velocity_range[1] - displacement_vel),
-                                                   self.granularity))
-
-        displacement_pos = random() * tile_size[0]
-        displacement_vel = random() * tile_size[1]
-        # Create tile move down right
-        return_tiles.append(self.create_empty_tile((self.pos_range[0] - displacement_pos, self.pos_range[1] - displacement_pos),
-                                                   (self.velocity_range[0] + displacement_vel,
-                                                    self.velocity_range[1] + displacement_vel),
-                                                   self.granularity))
-
-        displacement_pos = random() * tile_size[0]
-        displacement_vel = random() * tile_size[1]
-        # Create tile move down left
-        return_tiles.append(self.create_empty_tile((self.pos_range[0] - displacement_pos, self.pos_range[1] - displacement_pos),
-                                                   (self.velocity_range[0] - displacement_vel,
-                                                    self.velocity_range[1] - displacement_vel),
-                                                   self.granularity))
-
-        return return_tiles
-
-    def create_empty_tile(self, pos_range, velocity_range, granularity):
-        encoding_array = []
-
-        positions_start = np.linspace(
-            pos_range[0], pos_range[1], granularity[0] + 1)[:-1]
-        positions_end = positions_start + \
-            abs((positions_start[1] - positions_start[0]))
-
-        vel_starts = np.linspace(
-            velocity_range[0], velocity_range[1], granularity[1] + 1)[:-1]
-        vel_ends = vel_starts + abs((vel_starts[1] - vel_starts[0]))
-
-        # Create the array with all zeros
-        for i in range(self.granularity[0]):
-            row = []
-            for j in range(self.granularity[1]):
-                row.append(0)
-            encoding_array.append(row)
-
-        df = pd.DataFrame(encoding_array, index=self._create_axis_bins(vel_starts, vel_ends),
-                          columns=self._create_axis_bins(positions_start, positions_end))
-
-        return df
+    def get_coarse_encoding_batch(self, pos, vel):
+        """
+        Gets the tile encodings of many states at once.
+        :param pos: numpy array of positions, shape (n,)
+        :param vel: numpy array of velocities, shape (n,)
+        :return: numpy array of shape (n, n_tilings, tiles[1], tiles[0]), or (n, hash_size) with hashing
+        """
+        features = self.get_active_features_batch(pos, vel)
+        encoding = np.zeros((len(features), self.n_features), dtype=int)
+        states, tilings = np.nonzero(features >= 0)
+        encoding[states, features[states, tilings]] = 1
+        if self.iht is not None:
+            return encoding
+        return encoding.reshape(len(features), self.n_tilings, self.tiles[1], self.tiles[0])
+
+    def get_active_features_batch(self, pos, vel):
+        """
+        Gets the active feature indices of many states at once.
+        :param pos: numpy array of positions, shape (n,)
+        :param vel: numpy array of velocities, shape (n,)
+        :return: int32 numpy array of shape (n, n_tilings), -1 where a state is outside a tiling
+        """
+        cells = self._active_cells(np.asarray(pos, dtype=float), np.asarray(vel, dtype=float))
+        features = np.where(cells >= 0, cells + self._tiling_starts, -1)
+        if self.iht is not None:
+            features = self.iht.index_batch(features)
+        return features.astype(np.int32)
 
-    @staticmethod
-    def _create_axis_bins(starts, ends):
+    def _active_cells(self, pos, vel):
         """
-        Given the start and end of a list of bins, returns the ranges of all the bins.
-        :param starts: The starts of the bins
-        :param ends: The ends of the bins
-        :return: The ranges of all the bins
+        Computes the active cell of every tiling by floor division on the tile offsets.
+        Cells are numbered row-major, i.e. vel_bin * tiles[0] + pos_bin.
+        :param pos: numpy array of positions, shape (n,)
+        :param vel: numpy array of velocities, shape (n,)
+        :return: int numpy array of shape (n, n_tilings), -1 where the state is outside the tiling
         """
-        bins = []
-        for i in range(len(starts)):
-            bins.append((starts[i], ends[i]))
-        return bins
+        pos_bins = np.floor(
+            (pos[:, None] - self.offsets[:, 0]) / self.tile_size[0]).astype(np.int64)
+        vel_bins = np.floor(
+            (vel[:, None] - self.offsets[:, 1]) / self.tile_size[1]).astype(np.int64)
+        inside = (pos_bins >= 0) & (pos_bins < self.tiles[0]) & \
+            (vel_bins >= 0) & (vel_bins < self.tiles[1])
+        return np.where(inside, vel_bins * self.tiles[0] + pos_bins, -1)
 
-    @staticmethod
-    def _value_in_bin(val, b):
+    def _init_tiles(self):
         """
-        Returns True if the value is in the bin, else False
-        :param val: The value
-        :param b: The bin (start_val, end_val)
-        :return: True if value in bin, else False
+        Create five tilings, four displaced from the one in the center.
+        A tiling is represented by the lower (position, velocity) corner of its first cell.
+        :return: numpy array of shape (5, 2)
+        """
+        # (position sign, velocity sign) of the displacement: center, up right, up left, down right, down left
+        directions = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+        offsets = [(self.pos_range[0], self.velocity_range[0])]
+        for pos_sign, vel_sign in directions:
+            displacement_pos = random() * self.tile_size[0]
+            displacement_vel = random() * self.tile_size[1]
+            offsets.append((self.pos_range[0] + pos_sign * displacement_pos,
+                            self.velocity_range[0] + vel_sign * displacement_vel))
+        return np.array(offsets)
+
+    def _even_tiles(self, seed=None):
+        """
+        Create n_tilings tilings, tiling k displaced by k/n_tilings of a tile times the asymmetric vector (1, 3),
+        which spreads the tilings more evenly than equal displacements on both axes (Miller and Glanz).
+        All tilings are shifted by the same seeded random fraction of a tile, and start at or below the range.
+        :return: numpy array of shape (n_tilings, 2)
         """
-        return b[0] <= val < b[1]
+        if seed is None:
+            shift = np.array([random(), random()])
+        else:
+            shift = np.random.default_rng(seed).uniform(0, 1, 2)
+        fractions = (np.arange(self.n_tilings)[:, None] * np.array([1, 3]) / self.n_tilings + shift) % 1
+        return np.array([self.pos_range[0], self.velocity_range[0]]) - fractions * self.tile_size
 
 
 if __name__ == '__main__':
-    a = TileEncoder((-1.21, 0.61), (-0.071, 0.071), (4, 4))
-    print(a.get_encoding(0.0, 0.03))
+    a = TileEncoder({'pos_range': (-1.21, 0.61),
+                     'velocity_range': (-0.071, 0.071), 'granularity': (4, 4)})
+    print(a.get_coarse_encoding(0.0, 0.03))
@@ -1,10 +1,5 @@
-import math
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
-from environment.coarsecoder import CoarseCoder, TileEncoder
+from environment.coarsecoder import TileEncoder
 from environment.car import Car
-import yaml
 
 
 class Environment:
@@ -17,30 +12,21 @@ class Environment:
         self.coarse_code = TileEncoder(config)
         self.car = Car(config)
         self.steps = 0
+        # Sparse states are tuples of active feature indices, one per tiling, instead of dense arrays
+        self.sparse_state = config.get("sparse_state", False)
+        if config.get("hash_size") and not self.sparse_state:
+            # The hashed dense encoding is a flat vector, which the actor and critic would take for feature indices
+            raise ValueError("hash_size needs sparse_state: True")
 
-    def visualize_landscape(self, car_positions):
-        # the relationship between x and height (depth) is given by:
-        car_heights = [math.cos(3 * (pos + math.pi / 2))
-                       for pos in car_positions]
-        fig, ax = plt.subplots(figsize=(5, 3))
-        ax.set(xlim=(self.car.minp, self.car.maxp), ylim=(-1.5, 1.5))
-
-        x = np.linspace(self.car.minp, self.car.maxp, 91)
-        y = [math.cos(3 * (pos + math.pi / 2)) for pos in x]
-
-        ax.plot(x, y, 'k', lw=1)
-        car = ax.plot(car_positions[0], car_heights[0], 'ro', lw=4)[0]
-
-        def animate(i):
-            car.set_xdata(car_positions[i])
-            car.set_ydata(car_heights[i])
-
-        anim = FuncAnimation(fig, animate, interval=100,
-                             frames=len(car_positions)-1)
-        anim.save('filename.mp4')
-
-        plt.draw()
-        plt.show()
+    def visualize_landscape(self, car_positions, filename='filename.mp4', subsample=1, blit=False, show=True):
+        """
+        Animates the car positions on the landscape, saves the animation and shows it (blocking).
+        Use environment.render to render saved trajectories without blocking training.
+        """
+        # matplotlib is only loaded when something is visualized
+        from environment.render import animate_landscape
+        animate_landscape(car_positions, filename, subsample=subsample, blit=blit, show=show,
+                          position_range=(self.car.minp, self.car.maxp))
 
     def update_steps(self):
         self.steps += 1
@@ -89,6 +75,8 @@ class Environment:
 
     def get_state(self):
         pos, vel, _ = self.car.get_state()
+        if self.sparse_state:
+            return self.coarse_code.get_active_features(pos, vel)
         return self.coarse_code.get_coarse_encoding(pos, vel)
 
     def get_position(self):
@@ -0,0 +1,133 @@
+"""
+Saving and rendering of car trajectories.
+
+During training, trajectories are saved as small .npz files (episode id and float32 positions), which is cheap.
+Animations are rendered from those files by a BackgroundRenderer process, or afterwards with
+    python -m environment.render trajectories/ --subsample 2
+which writes one animation per episode next to each file.
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import numpy as np
+
+
+def save_trajectory(directory, episode, positions):
+    """
+    Saves the positions of one episode as <directory>/episode_<episode>.npz.
+    :return: the path of the file
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "episode_{:05d}.npz".format(episode))
+    np.savez(path, episode=episode, positions=np.asarray(positions, dtype=np.float32))
+    return path
+
+
+def animate_landscape(car_positions, filename=None, subsample=1, blit=True, interval=100, show=False,
+                      position_range=(-1.2, 0.6)):
+    """
+    Animates the car driving on the landscape, and saves the animation if a filename is given.
+    :param car_positions: list or numpy array of positions
+    :param filename: str, .mp4 (needs ffmpeg) or .gif (optional)
+    :param subsample: int, only every subsample-th position becomes a frame
+    :param blit: bool, only redraw the car on every frame
+    :param interval: int, milliseconds between frames
+    :param show: bool, open a (blocking) window with the animation
+    :param position_range: (min, max) position, the x limits of the plot
+    """
+    import matplotlib
+    if not show:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FuncAnimation
+
+    positions = np.asarray(car_positions)[::subsample]
+    # the relationship between x and height (depth) is given by:
+    car_heights = np.cos(3 * (positions + np.pi / 2))
+    fig, ax = plt.subplots(figsize=(5, 3))
+    ax.set(xlim=position_range, ylim=(-1.5, 1.5))
+
+    x = np.linspace(position_range[0], position_range[1], 91)
+    ax.plot(x, np.cos(3 * (x + np.pi / 2)), 'k', lw=1)
+    car = ax.plot(positions[:1], car_heights[:1], 'ro', lw=4)[0]
+
+    def animate(i):
+        car.set_data(positions[i:i + 1], car_heights[i:i + 1])
+        return car,
+
+    anim = FuncAnimation(fig, animate, interval=interval, blit=blit,
+                         frames=max(1, len(positions) - 1))
+    if filename:
+        anim.save(filename)
+    if show:
+        plt.show()
+    plt.close(fig)
+
+
+def render_file(path, output_format="mp4", subsample=1, blit=True):
+    """
+    Renders a trajectory saved by save_trajectory to a file next to it with the same name.
+    :return: the path of the animation
+    """
+    with np.load(path) as data:
+        positions = data["positions"]
+    output = os.path.splitext(path)[0] + "." + output_format
+    animate_landscape(positions, output, subsample=subsample, blit=blit)
+    return output
+
+
+def _render_worker(queue, output_format, subsample, blit):
+    """
+    Renders trajectory files from the queue until it receives None.
+    """
+    while True:
+        path = queue.get()
+        if path is None:
+            return
+        try:
+            render_file(path, output_format, subsample, blit)
+        except Exception as error:
+            # A failed animation (e.g. no ffmpeg for mp4) must not stop the others
+            print("Rendering {} failed: {}".format(path, error))
+
+
+class BackgroundRenderer:
+    """
+    Renders trajectory files in a separate process, so training never waits for an animation.
+    """
+
+    def __init__(self, output_format="mp4", subsample=1, blit=True):
+        context = multiprocessing.get_context("spawn")
+        self.queue = context.Queue()
+        self.process = context.Process(target=_render_worker, args=(self.queue, output_format, subsample, blit),
+                                       daemon=True)
+        self.process.start()
+
+    def submit(self, path):
+        self.queue.put(path)
+
+    def close(self):
+        """
+        Waits for the queued animations to be rendered.
+        """
+        self.queue.put(None)
+        self.process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="directory with episode_*.npz trajectories")
+    parser.add_argument("--format", default="mp4", choices=["mp4", "gif"])
+    parser.add_argument("--subsample", type=int, default=1)
+    parser.add_argument("--no-blit", dest="blit", action="store_false")
+    parser.add_argument("--overwrite", action="store_true", help="also render episodes that already have an animation")
+    args = parser.parse_args()
+    for path in sorted(glob.glob(os.path.join(args.directory, "episode_*.npz"))):
+        if not args.overwrite and os.path.exists(os.path.splitext(path)[0] + "." + args.format):
+            continue
+        print(render_file(path, args.format, args.subsample, args.blit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import numpy as np
+from environment.coarsecoder import TileEncoder
+from environment.car import Car
+
+
+class VectorEnvironment:
+    """
+    Steps n mountain cars at once, keeping positions, velocities, step counters and done flags in numpy arrays.
+    Uses the dynamics of Car, the rewards of Environment.perform_action and the same end of episode conditions
+    (the top is reached or max_steps steps have been taken).
+    """
+
+    def __init__(self, config, n_cars, coarse_code=None, auto_reset=True):
+        """
+        :param config: dict, the Environment config
+        :param n_cars: int
+        :param coarse_code: TileEncoder (optional, shared with another environment to get the same tilings)
+        :param auto_reset: bool, whether cars that finish an episode are put back at the initial state
+        """
+        self.config = config
+        self.n_cars = n_cars
+        self.max_steps = config["max_steps"]
+        self.initial_state = config["initial_state"]
+        self.sparse_state = config.get("sparse_state", False)
+        if config.get("hash_size") and not self.sparse_state:
+            # The hashed dense encoding is a flat vector, which the actor and critic would take for feature indices
+            raise ValueError("hash_size needs sparse_state: True")
+        self.coarse_code = coarse_code if coarse_code is not None else TileEncoder(config)
+        self.auto_reset = auto_reset
+        car = Car(config)
+        self.minv, self.maxv, self.minp, self.maxp = car.minv, car.maxv, car.minp, car.maxp
+        self.positions = np.empty(n_cars)
+        self.velocities = np.empty(n_cars)
+        self.steps = np.zeros(n_cars, dtype=np.int64)
+        self.done = np.zeros(n_cars, dtype=bool)
+        # Length of the last finished episode of every car, -1 until a car has finished one
+        self.episode_steps = np.full(n_cars, -1, dtype=np.int64)
+        self.reset()
+
+    def reset(self, mask=None, positions=None, velocities=None):
+        """
+        Puts cars back at a start state, the configured initial state unless positions/velocities are given.
+        :param mask: bool numpy array selecting the cars to reset (all cars if None)
+        :param positions: float or numpy array of start positions for the selected cars
+        :param velocities: float or numpy array of start velocities for the selected cars
+        """
+        if mask is None:
+            mask = np.ones(self.n_cars, dtype=bool)
+        self.positions[mask] = self.initial_state[0] if positions is None else positions
+        self.velocities[mask] = self.initial_state[1] if velocities is None else velocities
+        self.steps[mask] = 0
+        self.done[mask] = False
+
+    def get_actions(self):
+        return [1, 0, -1]
+
+    def step(self, actions):
+        """
+        Performs one action for every car that is not done.
+        With auto_reset, cars whose episode ends are reset, so their next state is the initial state.
+        Without it they stay done (and receive reward 0) until reset() is called.
+        :param actions: int numpy array of shape (n_cars,) with values in {1, 0, -1}
+        :return: (rewards, finished) where finished flags the cars whose episode ended on this step
+        """
+        actions = np.asarray(actions)
+        active = ~self.done
+        old_vel = self.velocities
+
+        velocities = np.clip(old_vel + 0.001 * actions - 0.0025 * np.cos(3 * self.positions),
+                             self.minv, self.maxv)
+        positions = np.clip(self.positions + velocities, self.minp, self.maxp)
+        self.velocities = np.where(active, velocities, old_vel)
+        self.positions = np.where(active, positions, self.positions)
+        self.steps += active
+
+        rewards = np.where(np.round(self.positions, 1) == 0.6, 500,
+                           ((old_vel > 0.001) & (actions == 1)) | ((old_vel < -0.001) & (actions == -1)))
+        rewards = np.where(active, rewards, 0).astype(np.int64)
+
+        finished = active & (self.reached_top() | (self.steps == self.max_steps))
+        self.done |= finished
+        self.episode_steps[finished] = self.steps[finished]
+        if self.auto_reset and finished.any():
+            self.reset(finished)
+        return rewards, finished
+
+    def reached_top(self):
+        return np.round(self.positions, 2) == 0.6
+
+    def get_states(self):
+        """
+        Encodes the states of all cars with the tile coder.
+        :return: (n_cars, n_tilings) active feature indices with sparse_state, else (n_cars, n_tilings, G, G) arrays
+        """
+        if self.sparse_state:
+            return self.coarse_code.get_active_features_batch(self.positions, self.velocities)
+        return self.coarse_code.get_coarse_encoding_batch(self.positions, self.velocities)
@@ -0,0 +1,122 @@
+"""
+Greedy evaluation of a trained actor from many start states at once.
+
+All start states are rolled out together in a VectorEnvironment with the tile coder of the training environment,
+epsilon 0 and one batched table lookup per step, e.g.
+    positions, velocities = grid_start_states(50, 50)
+    evaluation = evaluate_policy(actor, env, positions, velocities)
+    evaluation["success_rate"], evaluation["success"]  # the latter is a (50, 50) map
+"""
+import json
+import numpy as np
+from environment.vector_environment import VectorEnvironment
+
+POSITION_RANGE = (-1.2, 0.6)
+VELOCITY_RANGE = (-0.07, 0.07)
+
+
+def grid_start_states(n_positions, n_velocities, position_range=POSITION_RANGE, velocity_range=VELOCITY_RANGE):
+    """
+    Start states on an evenly spaced grid, the goal position itself is left out.
+    :return: (positions, velocities), both of shape (n_velocities, n_positions)
+    """
+    positions = np.linspace(position_range[0], position_range[1], n_positions, endpoint=False)
+    velocities = np.linspace(velocity_range[0], velocity_range[1], n_velocities)
+    return np.meshgrid(positions, velocities)
+
+
+def random_start_states(n, seed=None, position_range=POSITION_RANGE, velocity_range=VELOCITY_RANGE):
+    """
+    Uniformly sampled start states.
+    :return: (positions, velocities), both of shape (n,)
+    """
+    rng = np.random.default_rng(seed)
+    return rng.uniform(*position_range, n), rng.uniform(*velocity_range, n)
+
+
+def evaluate_policy(actor, env, positions, velocities, critic=None, max_steps=None):
+    """
+    Runs the greedy policy of the actor from every start state until the top or max_steps is reached.
+    The actor's epsilon is not used or changed.
+    :param actor: Actor
+    :param env: Environment the actor was trained in (its tile coder and config are used, its tile hash table is
+        left unchanged)
+    :param positions: numpy array of start positions, any shape
+    :param velocities: numpy array of start velocities, same shape
+    :param critic: Critic (optional, to also return the predicted values of the start states)
+    :param max_steps: int (defaults to the max_steps of the environment)
+    :return: dict with success_rate, steps_mean/steps_median/steps_p90 over the successful starts,
+             and success (bool), steps (steps taken) and value (if critic is given) in the shape of positions
+    """
+    positions = np.asarray(positions, dtype=float)
+    velocities = np.asarray(velocities, dtype=float)
+    shape = positions.shape
+    config = dict(env.config)
+    if max_steps is not None:
+        config["max_steps"] = max_steps
+    cars = VectorEnvironment(config, positions.size, coarse_code=env.coarse_code, auto_reset=False)
+    cars.reset(positions=positions.ravel(), velocities=velocities.ravel())
+
+    # The rollout would otherwise add every tile it reaches to a tile hash table still in use by training
+    with env.coarse_code.preserved_hash_table():
+        values = None
+        if critic is not None:
+            values = np.asarray(critic.predict_batch(cars.get_states()), dtype=float).reshape(shape)
+
+        actions = np.zeros(cars.n_cars, dtype=np.int64)
+        while not cars.done.all():
+            active = ~cars.done
+            actions[active] = actor.get_greedy_actions(cars.get_states()[active])
+            cars.step(actions)
+
+    success = cars.reached_top()
+    steps = cars.episode_steps
+    successful_steps = steps[success]
+    result = {"success_rate": float(success.mean()),
+              "steps_mean": float(successful_steps.mean()) if len(successful_steps) else float("nan"),
+              "steps_median": float(np.median(successful_steps)) if len(successful_steps) else float("nan"),
+              "steps_p90": float(np.percentile(successful_steps, 90)) if len(successful_steps) else float("nan"),
+              "success": success.reshape(shape), "steps": steps.reshape(shape)}
+    if values is not None:
+        result["value"] = values
+    return result
+
+
+class PeriodicEvaluation:
+    """
+    Evaluates the greedy policy on a grid of start states every few training episodes,
+    and appends the summary of every evaluation to a .jsonl file.
+    """
+
+    def __init__(self, config):
+        """
+        :param every: int, evaluate after every every-th episode
+        :param grid: [n_positions, n_velocities] (optional, default 20 x 20)
+        :param max_steps: int (optional, defaults to the max_steps of the environment)
+        :param output: str, .jsonl file (optional)
+        """
+        self.every = config["every"]
+        self.max_steps = config.get("max_steps")
+        self.positions, self.velocities = grid_start_states(*config.get("grid", (20, 20)))
+        self._file = open(config["output"], "a") if config.get("output") else None
+        self.results = []
+
+    def after_episode(self, episode, actor, env):
+        """
+        Evaluates if episode + 1 is a multiple of every.
+        :return: the summary dict, or None if nothing was evaluated
+        """
+        if (episode + 1) % self.every:
+            return None
+        evaluation = evaluate_policy(actor, env, self.positions, self.velocities, max_steps=self.max_steps)
+        summary = {"episode": episode, **{key: value for key, value in evaluation.items()
+                                          if not isinstance(value, np.ndarray)}}
+        self.results.append(summary)
+        if self._file is not None:
+            self._file.write(json.dumps(summary) + "\n")
+            self._file.flush()
+        return summary
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
@@ -0,0 +1,103 @@
+"""
+Frozen greedy policy for fast rollouts without the training code.
+
+The active tile of every tiling only changes where (position, velocity) crosses a tile edge of some tiling, so
+the edges of all tilings together cut the state space into rectangles on which the encoded state, and with it the
+greedy action, is constant. export_policy stores the action of every rectangle as a uint8 table with the sorted
+edges, and FrozenPolicy (which only needs numpy) finds the rectangle of a state with two binary searches:
+    export_policy(actor, env, "policy.npz")
+    policy = FrozenPolicy("policy.npz")
+    policy.action(-0.5, 0.0), policy.actions(positions, velocities)
+"""
+from bisect import bisect_right
+import numpy as np
+
+
+def axis_edges(offsets, tile_size, n_tiles):
+    """
+    Returns the sorted, distinct tile edges of all tilings along one axis.
+    :param offsets: numpy array with the start of every tiling along the axis
+    :param tile_size: float
+    :param n_tiles: int, tiles per tiling along the axis
+    """
+    edges = offsets[:, None] + tile_size * np.arange(n_tiles + 1)
+    return np.unique(edges)
+
+
+def region_centers(edges, tile_size):
+    """
+    Returns a point inside every region edges cut the axis into, including the two unbounded ones at the ends.
+    """
+    return np.concatenate(([edges[0] - tile_size / 2], (edges[:-1] + edges[1:]) / 2, [edges[-1] + tile_size / 2]))
+
+
+def export_policy(actor, env, path=None):
+    """
+    Evaluates the greedy action of the actor in every region and saves the table.
+    :param actor: Actor
+    :param env: Environment the actor was trained in (its tile coder is used)
+    :param path: str or file object for the .npz (optional)
+    :return: dict with position_edges, velocity_edges, table (uint8 action indices, [velocity, position]) and actions
+    """
+    coder = env.coarse_code
+    position_edges = axis_edges(coder.offsets[:, 0], coder.tile_size[0], coder.tiles[0])
+    velocity_edges = axis_edges(coder.offsets[:, 1], coder.tile_size[1], coder.tiles[1])
+    positions, velocities = np.meshgrid(region_centers(position_edges, coder.tile_size[0]),
+                                        region_centers(velocity_edges, coder.tile_size[1]))
+    with coder.preserved_hash_table():
+        if env.sparse_state:
+            states = coder.get_active_features_batch(positions.ravel(), velocities.ravel())
+        else:
+            states = coder.get_coarse_encoding_batch(positions.ravel(), velocities.ravel())
+        greedy = actor.get_greedy_actions(states)
+    actions = np.array(actor.actions, dtype=np.int8)
+    table = np.argmax(greedy[:, None] == actions, axis=1).astype(np.uint8).reshape(positions.shape)
+    frozen = {"position_edges": position_edges, "velocity_edges": velocity_edges, "table": table,
+              "actions": actions}
+    if path is not None:
+        np.savez(path, **frozen)
+    return frozen
+
+
+class FrozenPolicy:
+    """
+    Greedy policy read from a table saved by export_policy.
+    """
+
+    def __init__(self, source):
+        """
+        :param source: path or file object of the .npz, or the dict returned by export_policy
+        """
+        if isinstance(source, dict):
+            data = source
+        else:
+            with np.load(source) as file:
+                data = {name: file[name] for name in file.files}
+        self.position_edges = data["position_edges"]
+        self.velocity_edges = data["velocity_edges"]
+        self.table = data["table"]
+        self.action_values = data["actions"]
+        # Lookup table of actions for the batched path, python lists for the single state path
+        self._action_table = self.action_values[self.table]
+        self._position_list = self.position_edges.tolist()
+        self._velocity_list = self.velocity_edges.tolist()
+        self._rows = self._action_table.tolist()
+
+    def action(self, position, velocity):
+        """
+        Returns the greedy action of one state.
+        :param position: float
+        :param velocity: float
+        :return: int
+        """
+        return self._rows[bisect_right(self._velocity_list, velocity)][bisect_right(self._position_list, position)]
+
+    def actions(self, positions, velocities):
+        """
+        Returns the greedy actions of many states.
+        :param positions: numpy array
+        :param velocities: numpy array of the same shape
+        :return: int8 numpy array of actions
+        """
+        return self._action_table[np.searchsorted(self.velocity_edges, velocities, side="right"),
+                                  np.searchsorted(self.position_edges, positions, side="right")]
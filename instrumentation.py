@@ -0,0 +1,146 @@
+"""
+Timers and counters around the hot path of the training loop.
+
+Usage in the loop:
+    t = instrumentation.clock()
+    state = env.get_state()
+    t = instrumentation.record("encode", t)
+
+NullInstrumentation (used when instrumentation is off) makes clock/record no-ops, so the loop pays one method call
+per phase. Instrumentation sums the time and calls of every phase per episode, keeps the step latencies for
+p50/p99, and streams one row per episode to a .jsonl or .csv file while training runs. It can also run cProfile
+and tracemalloc for a range of episodes.
+"""
+import cProfile
+import csv
+import json
+import time
+import tracemalloc
+from collections import defaultdict
+import numpy as np
+
+PHASES = ("encode", "get_action", "perform_action",
+          "compute_td_err", "train", "actor_update")
+
+
+def create_instrumentation(config):
+    """
+    Creates the instrumentation described by the Training "instrumentation" config section, or a no-op one if unset.
+    :param config: dict or None with output, profile_episodes ([first, last + 1]), profile_output, trace_memory
+    """
+    if not config:
+        return NullInstrumentation()
+    return Instrumentation(output=config.get("output"), profile_episodes=config.get("profile_episodes"),
+                           profile_output=config.get("profile_output", "profile.prof"),
+                           trace_memory=config.get("trace_memory", False))
+
+
+class NullInstrumentation:
+    """
+    Does nothing, for when instrumentation is off.
+    """
+
+    def clock(self):
+        return 0.0
+
+    def record(self, phase, start):
+        return start
+
+    def end_step(self, start):
+        pass
+
+    def begin_episode(self, episode):
+        pass
+
+    def end_episode(self, episode, steps):
+        return None
+
+    def close(self):
+        pass
+
+
+class Instrumentation:
+
+    def __init__(self, output=None, profile_episodes=None, profile_output="profile.prof", trace_memory=False):
+        """
+        :param output: str, .csv or .jsonl file that gets one row per episode (optional)
+        :param profile_episodes: (first, last + 1) episodes to run cProfile over (optional)
+        :param profile_output: str, file for the cProfile stats, the tracemalloc snapshot goes to <file>.mem
+        :param trace_memory: bool, also trace allocations with tracemalloc over profile_episodes
+        """
+        self.clock = time.perf_counter
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.step_latencies = []
+        self.profile_episodes = profile_episodes
+        self.profile_output = profile_output
+        self.trace_memory = trace_memory
+        self.profiler = None
+        self.episode_start = None
+        self._file = open(output, "w", newline="") if output else None
+        self._csv = None
+        if output and output.endswith(".csv"):
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(["episode", "steps", "seconds", "p50_step_ms", "p99_step_ms"] +
+                               [column for phase in PHASES for column in (phase + "_s", phase + "_n")])
+
+    def record(self, phase, start):
+        """
+        Adds the time since start to phase.
+        :return: the current time, to use as start of the next phase
+        """
+        now = time.perf_counter()
+        self.totals[phase] += now - start
+        self.counts[phase] += 1
+        return now
+
+    def end_step(self, start):
+        self.step_latencies.append(time.perf_counter() - start)
+
+    def begin_episode(self, episode):
+        self.totals.clear()
+        self.counts.clear()
+        self.step_latencies = []
+        if self.profile_episodes and episode == self.profile_episodes[0]:
+            self.profiler = cProfile.Profile()
+            if self.trace_memory:
+                tracemalloc.start()
+            self.profiler.enable()
+        self.episode_start = time.perf_counter()
+
+    def end_episode(self, episode, steps):
+        """
+        Writes the totals of the episode to the output file.
+        :return: dict with the row that was written
+        """
+        seconds = time.perf_counter() - self.episode_start
+        if self.profiler is not None and episode + 1 >= self.profile_episodes[1]:
+            self._stop_profiling()
+        latencies = np.array(self.step_latencies) * 1e3
+        row = {"episode": episode, "steps": steps, "seconds": seconds,
+               "p50_step_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+               "p99_step_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+               "phases": {phase: {"seconds": self.totals[phase], "calls": self.counts[phase]}
+                          for phase in self.totals}}
+        if self._csv is not None:
+            self._csv.writerow([episode, steps, seconds, row["p50_step_ms"], row["p99_step_ms"]] +
+                               [value for phase in PHASES for value in (self.totals[phase], self.counts[phase])])
+        elif self._file is not None:
+            self._file.write(json.dumps(row) + "\n")
+        if self._file is not None:
+            self._file.flush()
+        return row
+
+    def _stop_profiling(self):
+        self.profiler.disable()
+        self.profiler.dump_stats(self.profile_output)
+        self.profiler = None
+        if self.trace_memory:
+            tracemalloc.take_snapshot().dump(self.profile_output + ".mem")
+            tracemalloc.stop()
+
+    def close(self):
+        if self.profiler is not None:
+            self._stop_profiling()
+        if self._file is not None:
+            self._file.close()
@@ -6,19 +6,67 @@
 # TODO: Illustration of mountain-car simulation status (normally visualized as a movie) with the curved line depicting the landscape and the oval denoting the mountain car.
 # TODO: Visualize the reward function
 
-from agent.critic import Critic
+import argparse
+import os
+import random
+import numpy as np
+from agent.base_critic import create_critic
 from agent.actor import Actor
+from checkpoint import TerminationFlag, load_checkpoint, restore_checkpoint, save_checkpoint
 from environment.environment import Environment
+from environment.render import BackgroundRenderer, save_trajectory
+from evaluation import PeriodicEvaluation, evaluate_policy, grid_start_states
+from value_map import PeriodicValueMap
+from instrumentation import NullInstrumentation, create_instrumentation
+from recorder import TransitionRecorder
 import yaml
-import matplotlib.pyplot as plt
-from copy import copy
-from tqdm import tqdm  # Progressbar
 
-config = yaml.full_load(open("configs/config.yml"))
-env_cfg = config["Environment"]
-actor_cfg = config["Actor"]
-critic_cfg = config["Critic"]
-training_cfg = config["Training"]
+# matplotlib, tqdm and tensorflow are imported where they are needed, so headless runs start quickly
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "configs", "config.yml")
+
+
+def load_config(path=DEFAULT_CONFIG, overrides=()):
+    """
+    Reads a config file and applies overrides to it.
+    :param path: str
+    :param overrides: list of "Section.key=value" strings, see apply_overrides
+    """
+    with open(path) as file:
+        config = yaml.full_load(file)
+    return apply_overrides(config, overrides)
+
+
+def apply_overrides(config, overrides):
+    """
+    Sets config values given as "Section.key=value", the value is parsed as YAML (e.g. Critic.internal_dims=[16]).
+    :param config: dict
+    :param overrides: list(str)
+    """
+    for override in overrides:
+        path, _, value = override.partition("=")
+        *sections, key = path.split(".")
+        section = config
+        for name in sections:
+            section = section[name]
+        section[key] = yaml.safe_load(value)
+    return config
+
+
+def seed_everything(seed, config):
+    """
+    Seeds python's and numpy's random generators, tensorflow's when the keras critic is used,
+    and the numpy critic's weight initialisation.
+    :param seed: int
+    :param config: dict
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    config["Critic"].setdefault("seed", seed)
+    if config["Critic"].get("backend", "keras") == "keras":
+        import tensorflow as tf
+        tf.random.set_seed(seed)
 
 
 def plot_learning(steps_per_episode):
@@ -26,6 +74,7 @@ def plot_learning(steps_per_episode):
     Plots remaining pieces after each episode during a full run of training
     Should converge to one if the agent is learning
     """
+    import matplotlib.pyplot as plt
     episode = [i for i in range(len(steps_per_episode))]
     plt.plot(episode, steps_per_episode)
     plt.xlabel("Episode number")
@@ -33,74 +82,277 @@ def plot_learning(steps_per_episode):
     plt.show()
 
 
-def main():
+def train_window(critic, actor, window, last_state, instrumentation, recorder=None, episode=None):
     """
-    Sets the parameters for the Environment, Critic, and Actor according to the imported config file.
-    Creates an environment where a predefined number of episodes can be performed.
-    Instantiates an actor to keep track of the policy, and a critic to keep track of the value at each state
+    Updates the critic on a window of steps with one batched call (Critic.train_batch),
+    then the actor step by step with the TD-errors of the window.
+    :param window: list of (state, action, reward, step, position, velocity)
+    :param last_state: the state reached after the last step of the window
+    :param recorder: TransitionRecorder the steps are recorded to (optional)
+    """
+    t = instrumentation.clock()
+    states = [step[0] for step in window] + [last_state]
+    td_errs = critic.compute_td_errs(states, [step[2] for step in window])
+    t = instrumentation.record("compute_td_err", t)
+    critic.train_batch(states[:-1], td_errs)
+    t = instrumentation.record("train", t)
+    for (state, action, _, _, _, _), td_err in zip(window, td_errs):
+        actor.step_update(state=state, action=action, td_err=td_err)
+    instrumentation.record("actor_update", t)
+    if recorder is not None:
+        for (_, action, reward, step, position, velocity), td_err in zip(window, td_errs):
+            recorder.record(episode, step, position,
+                            velocity, action, reward, td_err)
+
+
+def play_episode(env, actor, critic, update_window=1, instrumentation=None, recorder=None, episode=None,
+                 positions=None):
+    """
+    Plays one training episode, updating the critic and the actor after every step,
+    or every update_window steps with train_window (0 once at the end of the episode).
+    :param instrumentation: Instrumentation the phases are timed with (optional)
+    :param recorder: TransitionRecorder the steps are recorded to (optional)
+    :param episode: int, episode number for the instrumentation and the recorder
+    :param positions: list the position of the car is appended to after every step (optional)
+    :return: number of steps used
+    """
+    if instrumentation is None:
+        instrumentation = NullInstrumentation()
+    env.new_simulation()
+    critic.reset_eli_dict()
+    actor.reset_eli_dict()
+    instrumentation.begin_episode(episode)
+    window = []
+    while not env.reached_top() and not env.reached_max_steps():
+        env.update_steps()
+        step_start = t = instrumentation.clock()
+        position, velocity, _ = env.car.get_state()
+        current_state = env.get_state()
+        t = instrumentation.record("encode", t)
+        legal_actions = env.get_actions()
+        action = actor.get_action(
+            state=current_state, legal_actions=legal_actions)
+        t = instrumentation.record("get_action", t)
+        reward = env.perform_action(action=action)
+        t = instrumentation.record("perform_action", t)
+        next_state = env.get_state()
+        t = instrumentation.record("encode", t)
+
+        if update_window != 1:
+            # The critic and actor are updated once the window is full, see train_window
+            window.append((current_state, action, reward,
+                           env.steps, position, velocity))
+            if len(window) == update_window:
+                train_window(critic, actor, window, next_state,
+                             instrumentation, recorder, episode)
+                window = []
+            instrumentation.end_step(step_start)
+            if positions is not None:
+                positions.append(env.get_position())
+            continue
+
+        td_err = critic.compute_td_err(
+            current_state=current_state, next_state=next_state, reward=reward)
+        t = instrumentation.record("compute_td_err", t)
+
+        # Previous states on the path are updated as well during the call to train() by eligibility traces
+        critic.train(state=current_state, td_error=td_err)
+        critic.update_eligs()
+        t = instrumentation.record("train", t)
+
+        # Update actor beliefs on all SAPs with a live eligibility trace in the episode
+        actor.step_update(state=current_state,
+                          action=action, td_err=td_err)
+        instrumentation.record("actor_update", t)
+        instrumentation.end_step(step_start)
+
+        if recorder is not None:
+            recorder.record(episode, env.steps, position,
+                            velocity, action, reward, td_err)
+        if positions is not None:
+            positions.append(env.get_position())
+
+    if window:
+        train_window(critic, actor, window, next_state,
+                     instrumentation, recorder, episode)
+    instrumentation.end_episode(episode, env.steps)
+    return env.steps
+
+
+def train(config, seed=None, headless=False, resume=False):
+    """
+    Sets the parameters for the Environment, Critic, and Actor according to the config.
     Runs a predefined number of episodes creating a new board for each episode.
     For each episode, the actor and the critic are updated according to the Actor-Critic model.
-    Finally, epsilon is set to zero, and the environment plays a game with the updated policy.
+    :param config: dict
+    :param seed: int (optional)
+    :param headless: bool, no progress bar, printing or visualization
+    :param resume: bool, continue from the checkpoint in Training.checkpoint.directory if there is one
+    :return: (env, actor, critic, steps_per_episode)
     """
+    if seed is not None:
+        seed_everything(seed, config)
+    env_cfg = config["Environment"]
+    training_cfg = config["Training"]
 
     env = Environment(env_cfg)
-    granularity = env_cfg["granularity"]
-    critic = Critic(critic_cfg, granularity)
-    actor = Actor(actor_cfg)
+    critic = create_critic(config["Critic"], env.coarse_code.n_features)
+    actor = Actor(config["Actor"])
 
     episodes = training_cfg["number_of_episodes"]
-    visualize_episodes = training_cfg["visualize_episodes"]
+    visualize_episodes = [] if headless else training_cfg["visualize_episodes"]
     steps_per_episode = []
 
-    for episode in tqdm(range(episodes), desc=f"Playing {episodes} episodes", colour='#39ff14'):
-        env.new_simulation()
-        path = []
-        positions = []
-        critic.reset_eli_dict()
-        actor.reset_eli_dict()
-        while not env.reached_top() and not env.reached_max_steps():
-            env.update_steps()
-            current_state = copy(env.get_state())
-            legal_actions = env.get_actions()
-            action = actor.get_action(
-                state=current_state, legal_actions=legal_actions)
-            path.append((str(current_state), str(action)))
-            reward = env.perform_action(action=action)
-
-            td_err = critic.compute_td_err(
-                current_state=current_state, next_state=env.get_state(), reward=reward)
-
-            # Previous states on the path are updated as well during the call to train() by eligibility traces
-            critic.train(state=current_state, td_error=td_err)
-            critic.update_eligs()
-
-            # Update actor beliefs on SAPs for all pairs seen thus far in the episode
-            for i, sap in enumerate(reversed(path)):
-                actor.update_eli_dict(
-                    state=str(sap[0]), action=str(sap[1]), i=i)
-                actor.update_policy_dict(
-                    state=str(sap[0]), action=str(sap[1]), td_err=td_err)
+    # Checkpoints every `every` episodes, after the last episode and when SIGTERM is received
+    checkpoint_cfg = training_cfg.get("checkpoint") or {}
+    checkpoint_dir = checkpoint_cfg.get("directory")
+    checkpoint_every = checkpoint_cfg.get("every", 10)
+    start_episode = 0
+    if resume and checkpoint_dir:
+        checkpoint = load_checkpoint(checkpoint_dir)
+        if checkpoint is not None:
+            start_episode, steps_per_episode = restore_checkpoint(
+                checkpoint, env, actor, critic)
+    termination = TerminationFlag() if checkpoint_dir else None
 
-            positions.append(env.get_position())
+    instrumentation = create_instrumentation(
+        training_cfg.get("instrumentation"))
+    # 1 updates the critic every step, k > 1 every k steps and 0 once per episode (see train_window)
+    update_window = config["Critic"].get("update_window", 1)
+    evaluation_cfg = training_cfg.get("evaluation")
+    evaluation = PeriodicEvaluation(evaluation_cfg) if evaluation_cfg else None
+    value_map_cfg = training_cfg.get("value_map")
+    value_maps = PeriodicValueMap(value_map_cfg) if value_map_cfg else None
+    # Every transition is streamed to column files in this directory (see recorder.py)
+    transitions_dir = training_cfg.get("transitions_dir")
+    recorder = None
+    if transitions_dir:
+        recorder = TransitionRecorder(
+            transitions_dir, start_episode=start_episode)
+    # Trajectories of visualized episodes are saved, and rendered by another process unless render is inline/offline
+    render = training_cfg.get("render", "background")
+    trajectory_dir = training_cfg.get("trajectory_dir", "trajectories")
+    renderer = None
+    if visualize_episodes and render == "background":
+        renderer = BackgroundRenderer(training_cfg.get("render_format", "mp4"),
+                                      subsample=training_cfg.get("render_subsample", 1))
 
-        print("steps used in this episode", env.steps)
-        if episode in visualize_episodes:
-            env.visualize_landscape(positions)
+    progress = range(start_episode, episodes)
+    if not headless:
+        from tqdm import tqdm  # Progressbar
+        progress = tqdm(
+            progress, desc=f"Playing {episodes} episodes", colour='#39ff14', initial=start_episode, total=episodes)
+
+    for episode in progress:
+        positions = [] if episode in visualize_episodes else None
+        play_episode(env, actor, critic, update_window,
+                     instrumentation, recorder, episode, positions)
+        if recorder is not None:
+            recorder.flush()
+        if not headless:
+            print("steps used in this episode", env.steps)
+        if positions is not None:
+            path = save_trajectory(trajectory_dir, episode, positions)
+            if renderer is not None:
+                renderer.submit(path)
+            elif render == "inline":
+                env.visualize_landscape(positions, os.path.splitext(path)[0] + ".mp4",
+                                        subsample=training_cfg.get("render_subsample", 1))
         steps_per_episode.append(env.steps)
+        if evaluation is not None:
+            summary = evaluation.after_episode(episode, actor, env)
+            if summary is not None and not headless:
+                print("greedy success rate {:.2f}, median steps {}".format(
+                    summary["success_rate"], summary["steps_median"]))
+        if value_maps is not None:
+            value_maps.after_episode(episode, actor, critic, env)
 
-    plot_learning(steps_per_episode)
+        if checkpoint_dir and (termination.requested or episode + 1 == episodes or
+                               (checkpoint_every and (episode + 1) % checkpoint_every == 0)):
+            save_checkpoint(checkpoint_dir, episode + 1, env,
+                            actor, critic, steps_per_episode)
+        if termination is not None and termination.requested:
+            break
 
-    # Enable history tracking to visualize final simulation
-    env.new_simulation()
+    if termination is not None:
+        termination.restore()
+    instrumentation.close()
+    if evaluation is not None:
+        evaluation.close()
+    if recorder is not None:
+        recorder.close()
+    if renderer is not None:
+        renderer.close()
+    return env, actor, critic, steps_per_episode
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Trains an actor-critic agent on the mountain car problem.")
+    parser.add_argument("--config", default=DEFAULT_CONFIG,
+                        help="path to the config file (default: configs/config.yml)")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="SECTION.KEY=VALUE",
+                        help="override a config value, e.g. --set Critic.backend=numpy (repeatable)")
+    parser.add_argument("--episodes", type=int,
+                        help="number of training episodes (overrides Training.number_of_episodes)")
+    parser.add_argument("--seed", type=int, help="seed for all random generators")
+    parser.add_argument("--workers", type=int,
+                        help="train with this many worker processes (overrides Training.workers, see async_training)")
+    parser.add_argument("--checkpoint-dir",
+                        help="checkpoint to this directory (overrides Training.checkpoint.directory)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the checkpoint in the checkpoint directory")
+    parser.add_argument("--export-policy", metavar="PATH",
+                        help="save the trained greedy policy as a lookup table for frozen_policy.FrozenPolicy")
+    parser.add_argument("--headless", action="store_true",
+                        help="no progress bar, plots, animations or final simulation")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """
+    Trains an actor and a critic with the given config and plots the steps used per episode.
+    Finally, epsilon is set to zero, and the environment plays a game with the updated policy.
+    :param args: list(str), command line arguments (defaults to sys.argv)
+    """
+    args = parse_args(args)
+    config = load_config(args.config, args.overrides)
+    if args.episodes is not None:
+        config["Training"]["number_of_episodes"] = args.episodes
+    if args.checkpoint_dir is not None:
+        config["Training"]["checkpoint"] = dict(
+            config["Training"].get("checkpoint") or {}, directory=args.checkpoint_dir)
+    if args.workers is not None:
+        config["Training"]["workers"] = args.workers
+    if config["Training"].get("workers", 1) > 1:
+        if args.resume:
+            raise ValueError("--resume is not supported with workers > 1")
+        from async_training import train_async
+        env, actor, critic, steps_per_episode = train_async(
+            config, seed=args.seed, headless=args.headless)
+    else:
+        env, actor, critic, steps_per_episode = train(
+            config, seed=args.seed, headless=args.headless, resume=args.resume)
+    if args.export_policy:
+        from frozen_policy import export_policy
+        export_policy(actor, env, args.export_policy)
+    if args.headless:
+        return steps_per_episode
+
+    plot_learning(steps_per_episode)
 
     print(f"Actor final epsilon: {actor.epsilon}")
-    actor.epsilon = 0  # Set exploration to 0
+    # Greedy policy (no exploration) from the initial state and from a grid of start states
     print("Attempting final simulation to show you how smart I am now")
-    while not env.reached_top() and not env.reached_max_steps():
-        current_state = env.get_state()
-        legal_actions = env.get_actions()
-        action = actor.get_action(current_state, legal_actions)
-        env.perform_action(action)
+    initial_position, initial_velocity = config["Environment"]["initial_state"]
+    final = evaluate_policy(actor, env, [initial_position], [initial_velocity])
+    print("steps used from the initial state", int(final["steps"][0]),
+          "(reached the top)" if final["success"][0] else "(did not reach the top)")
+    grid = evaluate_policy(actor, env, *grid_start_states(50, 50))
+    print("greedy success rate from 50 x 50 start states {:.2f}, median steps {}".format(
+        grid["success_rate"], grid["steps_median"]))
+    return steps_per_episode
 
 
-main()
+if __name__ == '__main__':
+    main()
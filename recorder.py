@@ -0,0 +1,146 @@
+"""
+Transition log of a training run, written as one append-only column file per field.
+
+Every column file starts with a 32 byte header (magic, numpy dtype string, number of committed rows) followed by
+the raw values. The files grow in chunks of preallocated rows, so writing a step is one store per column into a
+memory map, and memory use stays fixed however long the run is. The row count in the header is only updated
+after the rows have been flushed, so
+    columns = read_transitions("transitions")
+memory-maps a consistent prefix of the log without copying it, also while training is still writing.
+"""
+import os
+import numpy as np
+
+COLUMNS = {"episode": "<i4", "step": "<i4", "position": "<f8", "velocity": "<f8", "action": "<i1",
+           "reward": "<f4", "td_error": "<f4"}
+MAGIC = b"MCCOLv1\0"
+HEADER_SIZE = 32
+
+
+def _read_header(file):
+    file.seek(0)
+    header = file.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or header[:8] != MAGIC:
+        raise ValueError("{} is not a transition column file".format(file.name))
+    dtype = np.dtype(header[8:16].rstrip(b"\0").decode())
+    length = int(np.frombuffer(header, dtype="<u8", count=1, offset=16)[0])
+    return dtype, length
+
+
+def _write_header(file, dtype, length):
+    file.seek(0)
+    file.write(MAGIC + dtype.str.encode().ljust(8, b"\0") +
+               np.array([length], dtype="<u8").tobytes() + bytes(8))
+
+
+def read_transitions(directory):
+    """
+    Memory-maps the committed rows of every column, read-only.
+    :param directory: str, directory written by a TransitionRecorder
+    :return: dict column name -> numpy memmap (all of the same length)
+    """
+    columns = {}
+    lengths = {}
+    for name in COLUMNS:
+        with open(os.path.join(directory, name + ".col"), "rb") as file:
+            dtype, lengths[name] = _read_header(file)
+        columns[name] = dtype
+    # Columns are committed one after the other, so use the rows every column has
+    length = min(lengths.values())
+    if length == 0:
+        return {name: np.empty(0, dtype) for name, dtype in columns.items()}
+    return {name: np.memmap(os.path.join(directory, name + ".col"), dtype=dtype, mode="r",
+                            offset=HEADER_SIZE, shape=(length,))
+            for name, dtype in columns.items()}
+
+
+class TransitionRecorder:
+    """
+    Streams (episode, step, position, velocity, action, reward, td_error) rows to column files in a directory.
+    """
+
+    def __init__(self, directory, chunk_size=65536, start_episode=0):
+        """
+        :param directory: str
+        :param chunk_size: int, rows added to the files every time they are full
+        :param start_episode: int, when resuming, the rows of this episode and later ones are dropped
+            and new rows are appended after the earlier ones, otherwise the log starts empty
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.length = 0
+        self.capacity = 0
+        self._files = {}
+        self._maps = {}
+        self._views = {}
+        existing = start_episode > 0 and os.path.exists(self._path("episode"))
+        for name, dtype in COLUMNS.items():
+            file = open(self._path(name), "r+b" if existing else "w+b")
+            if not existing:
+                _write_header(file, np.dtype(dtype), 0)
+            self._files[name] = file
+        if existing:
+            episodes = read_transitions(directory)["episode"]
+            # Episodes are written in increasing order
+            self.length = int(np.searchsorted(episodes, start_episode))
+            del episodes
+        self._grow(max(self.chunk_size, self.length))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + ".col")
+
+    def _grow(self, capacity):
+        """
+        Enlarges the files to hold capacity rows and maps them again.
+        """
+        self._release()
+        for name, dtype in COLUMNS.items():
+            dtype = np.dtype(dtype)
+            file = self._files[name]
+            file.truncate(HEADER_SIZE + capacity * dtype.itemsize)
+            self._maps[name] = np.memmap(file, dtype=dtype, mode="r+", offset=HEADER_SIZE, shape=(capacity,))
+            # Plain ndarray views skip the memmap subclass on every store
+            self._views[name] = self._maps[name].view(np.ndarray)
+        self.capacity = capacity
+
+    def _release(self):
+        for memmap in self._maps.values():
+            memmap.flush()
+        self._maps.clear()
+        self._views.clear()
+
+    def record(self, episode, step, position, velocity, action, reward, td_error):
+        if self.length == self.capacity:
+            self._grow(self.capacity + self.chunk_size)
+        i = self.length
+        views = self._views
+        views["episode"][i] = episode
+        views["step"][i] = step
+        views["position"][i] = position
+        views["velocity"][i] = velocity
+        views["action"][i] = action
+        views["reward"][i] = reward
+        views["td_error"][i] = td_error
+        self.length = i + 1
+
+    def flush(self):
+        """
+        Writes the rows recorded so far to disk and commits them in the headers, so readers see them.
+        """
+        for name, dtype in COLUMNS.items():
+            self._maps[name].flush()
+            _write_header(self._files[name], np.dtype(dtype), self.length)
+            self._files[name].flush()
+
+    def close(self):
+        """
+        Commits the recorded rows and cuts off the preallocated rows that were never used.
+        """
+        self.flush()
+        self._release()
+        for name, dtype in COLUMNS.items():
+            file = self._files[name]
+            file.truncate(HEADER_SIZE + self.length * np.dtype(dtype).itemsize)
+            file.close()
+        self._files.clear()
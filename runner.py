@@ -0,0 +1,162 @@
+"""
+Trains several seeds (and optionally several config variants) in parallel worker processes,
+and saves the steps per episode of every run plus a mean curve with a 95% confidence interval as .npz.
+
+Example, from the project root:
+    python runner.py --seeds 0 1 2 3 --variant "Critic.learning_rate=0.01" --variant "Critic.learning_rate=0.05"
+"""
+import argparse
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait
+from contextlib import contextmanager
+import numpy as np
+
+# Thread pools are limited to one thread per worker, the runner gets its parallelism from the processes
+SINGLE_THREAD_ENV = {
+    "OMP_NUM_THREADS": "1",
+    "OPENBLAS_NUM_THREADS": "1",
+    "MKL_NUM_THREADS": "1",
+    "TF_NUM_INTRAOP_THREADS": "1",
+    "TF_NUM_INTEROP_THREADS": "1",
+    "TF_CPP_MIN_LOG_LEVEL": "2",
+}
+
+
+@contextmanager
+def single_threaded_workers():
+    """
+    Sets SINGLE_THREAD_ENV while worker processes are started, and restores the environment afterwards.
+    Spawned processes inherit the environment when they start, so their thread pools are limited before they
+    import numpy (which a worker already does to unpickle its task, before any initializer could run).
+    """
+    previous = {name: os.environ.get(name) for name in SINGLE_THREAD_ENV}
+    os.environ.update(SINGLE_THREAD_ENV)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def train_run(config_path, overrides, seed):
+    """
+    Trains one headless, seeded run in a worker process.
+    :param config_path: str
+    :param overrides: list(str), "Section.key=value" overrides
+    :param seed: int
+    :return: numpy array with the steps used in every episode
+    """
+    from main import load_config, train
+    config = load_config(config_path, overrides)
+    _, _, _, steps_per_episode = train(config, seed=seed, headless=True)
+    return np.array(steps_per_episode)
+
+
+def summarize(curves):
+    """
+    Computes the mean curve and a 95% confidence interval over runs (normal approximation).
+    :param curves: numpy array of shape (runs, episodes)
+    :return: (mean, ci_low, ci_high)
+    """
+    mean = curves.mean(axis=0)
+    if len(curves) < 2:
+        return mean, mean.copy(), mean.copy()
+    half_width = 1.96 * curves.std(axis=0, ddof=1) / np.sqrt(len(curves))
+    return mean, mean - half_width, mean + half_width
+
+
+def run(config_path, seeds, variants=((),), workers=None, timeout=None):
+    """
+    Trains every (variant, seed) combination in a process pool.
+    Runs that raise or are still running after timeout seconds are reported, not raised.
+    :param config_path: str
+    :param seeds: list(int)
+    :param variants: list of override lists, one per config variant
+    :param workers: int (defaults to the number of cores)
+    :param timeout: float, seconds for the whole sweep (optional)
+    :return: (results, failures) with results[(variant_index, seed)] = steps per episode
+             and failures[(variant_index, seed)] = error message
+    """
+    config_path = os.path.abspath(config_path)
+    jobs = [(v, seed) for v in range(len(variants)) for seed in seeds]
+    results, failures = {}, {}
+    # Workers are spawned while jobs are submitted, so the pool lives inside the thread limits
+    with single_threaded_workers():
+        children = set(multiprocessing.active_children())
+        executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                       mp_context=multiprocessing.get_context("spawn"))
+        pool = []
+        try:
+            futures = {executor.submit(train_run, config_path, list(variants[v]), seed): (v, seed)
+                       for v, seed in jobs}
+            # The pool has started all of its workers by now, they are the new child processes
+            pool = [process for process in multiprocessing.active_children() if process not in children]
+            done, not_done = wait(futures, timeout=timeout)
+            for future in done:
+                job = futures[future]
+                try:
+                    results[job] = future.result()
+                except Exception:
+                    failures[job] = traceback.format_exc()
+            for future in not_done:
+                failures[futures[future]] = "timed out after {} s".format(timeout)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            # Runs that timed out would otherwise keep their worker busy until they finish
+            for process in pool:
+                if process.is_alive():
+                    process.terminate()
+    return results, failures
+
+
+def save_results(output, results, failures, seeds, variants):
+    """
+    Saves every run and the mean/CI curve of every variant as .npz.
+    Per variant i: curves_i (runs x episodes), seeds_i, mean_i, ci_low_i, ci_high_i.
+    """
+    arrays = {"variants": np.array([" ".join(v) for v in variants]),
+              "failed": np.array(["variant {} seed {}: {}".format(v, s, error.strip().splitlines()[-1])
+                                  for (v, s), error in sorted(failures.items())])}
+    for v in range(len(variants)):
+        ok_seeds = [seed for seed in seeds if (v, seed) in results]
+        if not ok_seeds:
+            continue
+        curves = np.stack([results[(v, seed)] for seed in ok_seeds])
+        mean, ci_low, ci_high = summarize(curves)
+        arrays.update({"curves_{}".format(v): curves, "seeds_{}".format(v): np.array(ok_seeds),
+                       "mean_{}".format(v): mean, "ci_low_{}".format(v): ci_low,
+                       "ci_high_{}".format(v): ci_high})
+    np.savez(output, **arrays)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default=os.path.join("configs", "config.yml"))
+    parser.add_argument("--seeds", type=int, nargs="+", default=list(range(4)))
+    parser.add_argument("--variant", action="append", default=None,
+                        help='space separated "Section.key=value" overrides, repeat for several variants')
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=None)
+    parser.add_argument("--output", default="runs.npz")
+    args = parser.parse_args()
+
+    variants = [tuple(v.split()) for v in args.variant] if args.variant else [()]
+    start = time.perf_counter()
+    results, failures = run(args.config, args.seeds, variants,
+                            workers=args.workers, timeout=args.timeout)
+    save_results(args.output, results, failures, args.seeds, variants)
+
+    print("{} runs finished in {:.1f} s, saved to {}".format(
+        len(results), time.perf_counter() - start, args.output))
+    for (v, seed), error in sorted(failures.items()):
+        print("variant {} seed {} failed: {}".format(v, seed, error.strip().splitlines()[-1]))
+
+
+if __name__ == '__main__':
+    main()
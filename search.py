@@ -0,0 +1,280 @@
+"""
+Successive-halving search over config parameters.
+
+A number of candidate configs is sampled from the given parameter ranges, and every candidate is trained for a
+few episodes in parallel worker processes. The candidates are ranked by their mean steps per episode over the last
+quarter of those episodes, and the best 1/eta of them are trained eta times longer, continuing from their
+checkpoints, until the survivors reach max_episodes. All candidates use the same seed. Candidates with the same
+score (in short early rungs all of them may use up max_steps in every episode) are ranked on their mean steps over
+all episodes, and a search whose survivors would still be chosen by a tie stops with an error.
+
+Every sampled candidate and every finished training is appended to ledger.jsonl in the search directory, so an
+interrupted search continues where it stopped when it is started again with the same arguments.
+
+Example, from the project root:
+    python search.py --param "Critic.learning_rate=log:0.001:0.1" --param "Environment.granularity=choice:[4, 4]|[6, 6]"
+        --candidates 27 --eta 3 --min-episodes 10 --max-episodes 90 --workers 4
+Parameters are given as Section.key=spec, with spec one of
+    uniform:low:high, log:low:high (log-uniform), int:low:high (both included) or choice:a|b|c (YAML values)
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import yaml
+from runner import single_threaded_workers
+
+# Searched when no --param is given. The Environment codes states with TileEncoder, so the overlaps of
+# CoarseEncoder (pos_overlap, velocity_overlap) would change nothing and are left out
+DEFAULT_SPACE = [
+    "Critic.learning_rate=log:0.001:0.1",
+    "Critic.eli_decay=uniform:0.5:0.95",
+    "Actor.learning_rate=log:0.01:0.5",
+    "Actor.eli_decay=uniform:0.5:0.95",
+    "Actor.epsilon_decay=choice:0.999|0.9995|0.9999|0.99995",
+    "Environment.granularity=choice:[4, 4]|[6, 6]|[8, 8]",
+]
+
+
+def parse_param(text):
+    """
+    Parses a "Section.key=spec" parameter range.
+    :return: (path, kind, values), values being (low, high) or the list of choices
+    """
+    path, _, spec = text.partition("=")
+    kind, _, values = spec.partition(":")
+    if kind == "choice":
+        return path, kind, [yaml.safe_load(value) for value in values.split("|")]
+    if kind in ("uniform", "log", "int"):
+        low, high = (float(value) for value in values.split(":"))
+        return path, kind, (low, high)
+    raise ValueError("Unknown parameter range {}, expected uniform, log, int or choice".format(spec))
+
+
+def sample_candidates(space, n, seed=None):
+    """
+    Samples n candidates from the parameter ranges.
+    :param space: list of "Section.key=spec" strings
+    :return: list of override lists, one per candidate, see main.apply_overrides
+    """
+    rng = np.random.default_rng(seed)
+    params = [parse_param(text) for text in space]
+    candidates = []
+    for _ in range(n):
+        overrides = []
+        for path, kind, values in params:
+            if kind == "choice":
+                value = values[rng.integers(len(values))]
+            elif kind == "log":
+                value = float(np.exp(rng.uniform(np.log(values[0]), np.log(values[1]))))
+            elif kind == "int":
+                value = int(rng.integers(values[0], values[1] + 1))
+            else:
+                value = float(rng.uniform(*values))
+            # JSON is valid YAML, so the override parses back to the same value
+            overrides.append("{}={}".format(path, json.dumps(value)))
+        candidates.append(overrides)
+    return candidates
+
+
+def mean_steps(steps):
+    """
+    Mean steps per episode over all the episodes, breaks ties in the score.
+    """
+    return float(np.mean(steps))
+
+
+def rung_budgets(min_episodes, max_episodes, eta):
+    """
+    Episodes trained by the candidates of every rung: min_episodes * eta ** k, the last one being max_episodes.
+    """
+    budgets = [min_episodes]
+    while budgets[-1] * eta < max_episodes:
+        budgets.append(budgets[-1] * eta)
+    if budgets[-1] < max_episodes:
+        budgets.append(max_episodes)
+    return budgets
+
+
+def score(steps):
+    """
+    Mean steps per episode over the last quarter of the episodes, lower is better.
+    """
+    return float(np.mean(steps[-max(1, len(steps) // 4):]))
+
+
+def train_candidate(config_path, overrides, seed, checkpoint_dir, episodes):
+    """
+    Trains one candidate to episodes in a worker process, continuing from its checkpoint if there is one.
+    Outputs that would be shared by all candidates (evaluation, value maps, transitions, timings) are switched off.
+    :return: (list with the steps of every episode, seconds spent)
+    """
+    from main import load_config, train
+    start = time.perf_counter()
+    config = load_config(config_path, overrides)
+    training_cfg = config["Training"]
+    training_cfg.update(number_of_episodes=episodes, checkpoint={"directory": checkpoint_dir, "every": 0},
+                        evaluation=None, value_map=None, transitions_dir=None, instrumentation=None)
+    _, _, _, steps_per_episode = train(config, seed=seed, headless=True, resume=True)
+    return [int(steps) for steps in steps_per_episode], time.perf_counter() - start
+
+
+class Ledger:
+    """
+    Append-only .jsonl record of a search, one JSON object per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        if os.path.exists(path):
+            valid = 0
+            with open(path, "rb") as file:
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    self.records.append(json.loads(line))
+                    valid += len(line)
+            # A line cut off by an interruption is dropped
+            os.truncate(path, valid)
+        self._file = open(path, "a")
+
+    def append(self, record):
+        self.records.append(record)
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def successive_halving(config_path, space, directory, n_candidates=27, eta=3, min_episodes=10, max_episodes=100,
+                       workers=None, seed=0):
+    """
+    Runs (or continues) a successive-halving search, see the module docstring.
+    :param config_path: str
+    :param space: list of "Section.key=spec" parameter ranges
+    :param directory: str, the ledger and the checkpoints of the candidates are kept here
+    :param n_candidates: int
+    :param eta: int, 1/eta of the candidates survive every rung
+    :param workers: int (defaults to the number of cores)
+    :param seed: int, seeds the sampling and every training run
+    :return: dict with candidates (override lists), results[rung][candidate] = (score, episodes, seconds, mean steps),
+             failures[rung][candidate] = error message, best (candidate index) and budgets
+    """
+    config_path = os.path.abspath(config_path)
+    os.makedirs(directory, exist_ok=True)
+    settings = {"event": "search", "config": config_path, "space": list(space), "candidates": n_candidates,
+                "eta": eta, "min_episodes": min_episodes, "max_episodes": max_episodes, "seed": seed}
+    budgets = rung_budgets(min_episodes, max_episodes, eta)
+    ledger = Ledger(os.path.join(directory, "ledger.jsonl"))
+    try:
+        if not ledger.records:
+            ledger.append(settings)
+        elif ledger.records[0] != settings:
+            raise ValueError("{} was written by a search with other settings: {}".format(
+                ledger.path, ledger.records[0]))
+        # Sampling is seeded, so a continued search samples the same candidates
+        candidates = sample_candidates(space, n_candidates, seed)
+        recorded = {record["id"] for record in ledger.records if record["event"] == "candidate"}
+        for index, overrides in enumerate(candidates):
+            if index not in recorded:
+                ledger.append({"event": "candidate", "id": index, "overrides": overrides})
+        results = [{} for _ in budgets]
+        failures = [{} for _ in budgets]
+        for record in ledger.records:
+            if record["event"] == "result":
+                results[record["rung"]][record["id"]] = (record["score"], record["episodes"], record["seconds"],
+                                                         mean_steps(record["steps"]))
+            elif record["event"] == "failure":
+                failures[record["rung"]][record["id"]] = record["error"]
+
+        survivors = list(range(len(candidates)))
+        for rung, episodes in enumerate(budgets):
+            pending = [index for index in survivors if index not in results[rung] and index not in failures[rung]]
+            if pending:
+                _train_rung(config_path, candidates, pending, rung, episodes, directory, seed, workers, ledger,
+                            results, failures)
+            rank = {index: (result[0], result[3]) for index, result in results[rung].items()}
+            ranked = sorted(rank, key=rank.get)
+            keep = max(1, math.ceil(len(survivors) / eta))
+            if len(ranked) > keep and rank[ranked[keep - 1]] == rank[ranked[keep]]:
+                raise ValueError(
+                    "Candidates {} and {} tie at {:.1f} steps per episode in rung {}, so the survivors would be chosen "
+                    "by their index. Start a search in a new directory with more min_episodes, so that exploration "
+                    "has left the max_steps cap by the end of the first rung".format(
+                        ranked[keep - 1], ranked[keep], rank[ranked[keep]][0], rung))
+            survivors = ranked[:keep]
+        return {"candidates": candidates, "results": results, "failures": failures,
+                "best": survivors[0] if survivors else None, "budgets": budgets}
+    finally:
+        ledger.close()
+
+
+def _train_rung(config_path, candidates, pending, rung, episodes, directory, seed, workers, ledger, results,
+                failures):
+    """
+    Trains the pending candidates of a rung in a process pool, recording every result as soon as it arrives.
+    """
+    executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                   mp_context=multiprocessing.get_context("spawn"))
+    with single_threaded_workers(), executor:
+        futures = {executor.submit(train_candidate, config_path, candidates[index], seed,
+                                   os.path.abspath(os.path.join(directory, "candidate_{}".format(index))),
+                                   episodes): index
+                   for index in pending}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                steps, seconds = future.result()
+            except Exception:
+                failures[rung][index] = traceback.format_exc()
+                ledger.append({"event": "failure", "id": index, "rung": rung, "error": failures[rung][index]})
+                continue
+            results[rung][index] = (score(steps), episodes, seconds, mean_steps(steps))
+            ledger.append({"event": "result", "id": index, "rung": rung, "episodes": episodes,
+                           "score": results[rung][index][0], "seconds": seconds, "steps": steps})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default=os.path.join("configs", "config.yml"))
+    parser.add_argument("--param", action="append", default=None,
+                        help='"Section.key=spec" parameter range, repeatable (defaults to DEFAULT_SPACE)')
+    parser.add_argument("--candidates", type=int, default=27)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--min-episodes", type=int, default=10)
+    parser.add_argument("--max-episodes", type=int, default=90)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--directory", default="search")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    search = successive_halving(args.config, args.param or DEFAULT_SPACE, args.directory,
+                                n_candidates=args.candidates, eta=args.eta, min_episodes=args.min_episodes,
+                                max_episodes=args.max_episodes, workers=args.workers, seed=args.seed)
+    # Survivors continue from their checkpoints, so a rung only adds the episodes beyond the previous budget
+    budgets = [0] + search["budgets"]
+    trained = sum(budgets[rung + 1] - budgets[rung]
+                  for rung, results in enumerate(search["results"]) for _ in results)
+    print("Search finished in {:.1f} s, {} episodes trained ({} to train every candidate fully)".format(
+        time.perf_counter() - start, trained, len(search["candidates"]) * args.max_episodes))
+    for rung, failures in enumerate(search["failures"]):
+        for index, error in sorted(failures.items()):
+            print("candidate {} failed in rung {}: {}".format(index, rung, error.strip().splitlines()[-1]))
+    if search["best"] is not None:
+        best = search["best"]
+        final = search["results"][-1][best]
+        print("Best candidate {}: {:.1f} steps per episode after {} episodes".format(best, final[0], final[1]))
+        print(" ".join('--set "{}"'.format(override) for override in search["candidates"][best]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the project are imported from the project root, as main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,77 @@
+"""
+Batched critic updates (BaseCritic.train_batch) against per-step TD(lambda) with train + update_eligs.
+"""
+import random
+import numpy as np
+import pytest
+from agent.base_critic import create_critic
+from environment.coarsecoder import TileEncoder
+
+ENV_CONFIG = {"pos_range": (-1.21, 0.61), "velocity_range": (-0.071, 0.071), "granularity": [4, 4]}
+CRITIC_CONFIG = {"learning_rate": 0.0001, "discount_factor": 0.99, "eli_decay": 0.85, "track_studied": False,
+                 "seed": 0}
+WINDOW = 8
+
+
+def trajectory(steps):
+    """
+    Active features of a car driven by random actions, and random TD errors.
+    """
+    # The offsets of the tilings are drawn from the global generator
+    random.seed(0)
+    rng = random.Random(0)
+    encoder = TileEncoder(ENV_CONFIG)
+    position, velocity = -0.5, 0.0
+    states = []
+    for _ in range(steps):
+        states.append(encoder.get_active_features(position, velocity))
+        velocity = min(max(velocity + 0.001 * rng.choice([1, 0, -1]) - 0.0025 * np.cos(3 * position), -0.07), 0.07)
+        position = min(max(position + velocity, -1.2), 0.6)
+    return states, [rng.uniform(-1, 1) for _ in range(steps)], encoder.n_features
+
+
+def weight_changes(config, window):
+    """
+    Trains a critic on three windows of the trajectory, per step (window 1) or with train_batch.
+    :return: list with the change of every weight array
+    """
+    states, td_errors, n_features = trajectory(3 * WINDOW)
+    # Every backend starts from the same seeded numpy initialisation
+    initial = create_critic(dict(config, backend="numpy"), n_features).get_weights()
+    critic = create_critic(config, n_features)
+    critic.set_weights(initial)
+    critic.reset_eli_dict()
+    if window == 1:
+        for state, td_error in zip(states, td_errors):
+            critic.train(state, td_error)
+            critic.update_eligs()
+    else:
+        for first in range(0, len(states), window):
+            critic.train_batch(states[first:first + window], td_errors[first:first + window])
+    return [w - w0 for w, w0 in zip(critic.get_weights(), initial)]
+
+
+def relative_error(expected, actual):
+    difference = np.sqrt(sum(np.sum((a - b) ** 2) for a, b in zip(expected, actual)))
+    return difference / np.sqrt(sum(np.sum(change ** 2) for change in expected))
+
+
+def test_linear_batch_update_equals_per_step():
+    # The gradient of a linear value function does not depend on the weights, so the updates are the same
+    config = dict(CRITIC_CONFIG, backend="numpy", linear=True, internal_dims=0)
+    per_step = weight_changes(config, 1)
+    batched = weight_changes(config, WINDOW)
+    for expected, actual in zip(per_step, batched):
+        np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-9)
+
+
+@pytest.mark.parametrize("backend, fused", [("numpy", False), ("keras", False), ("keras", True)])
+@pytest.mark.parametrize("first_layer, embedding_units", [("dense", None), ("embedding", None), ("embedding", 8)])
+def test_batch_update_matches_per_step(backend, fused, first_layer, embedding_units):
+    if backend == "keras":
+        pytest.importorskip("tensorflow")
+    config = dict(CRITIC_CONFIG, backend=backend, fused_update=fused, internal_dims=[16], first_layer=first_layer,
+                  embedding_units=embedding_units)
+    # Within a window the batched update uses the gradients at the weights the window started from,
+    # which only differ from the per-step ones by O(learning_rate)
+    assert relative_error(weight_changes(config, 1), weight_changes(config, WINDOW)) < 0.01
@@ -0,0 +1,118 @@
+"""
+Value function and greedy policy of a trained agent over a (position x velocity) grid.
+
+The grid is tile coded in one batched call, the critic predicts the values in a few large batches and the greedy
+actions are read from the actor's tables in one vectorized pass, e.g.
+    grid = value_map(critic, actor, env, 200, 200)
+    grid["value"], grid["action"]  # (200, 200) arrays, [velocity, position]
+    save_heatmaps(grid, "value_map.png")
+"""
+import os
+import numpy as np
+from evaluation import POSITION_RANGE, VELOCITY_RANGE
+
+
+def encode_grid(env, positions, velocities):
+    """
+    Tile codes every (position, velocity) pair with the tile coder of env.
+    With a hash table, tiles the grid adds to it are taken out again, so training is not affected.
+    :param positions: numpy array of shape (n,)
+    :param velocities: numpy array of shape (n,)
+    :return: (n, n_tilings) active feature indices with sparse_state, else the n dense encodings
+    """
+    coder = env.coarse_code
+    with coder.preserved_hash_table():
+        if env.sparse_state:
+            return coder.get_active_features_batch(positions, velocities)
+        return coder.get_coarse_encoding_batch(positions, velocities)
+
+
+def value_map(critic, actor, env, n_positions=200, n_velocities=200, batch_size=10000,
+              position_range=POSITION_RANGE, velocity_range=VELOCITY_RANGE):
+    """
+    Evaluates the critic and the greedy policy of the actor on an evenly spaced grid.
+    :param critic: critic (optional, None leaves out the values)
+    :param actor: Actor (optional, None leaves out the actions)
+    :param env: Environment the agent was trained in (its tile coder is used)
+    :param batch_size: int, states per call to the critic
+    :return: dict with positions (n_positions,) and velocities (n_velocities,), the grid axes,
+             value (float) and action (int8) of shape (n_velocities, n_positions)
+    """
+    positions = np.linspace(position_range[0], position_range[1], n_positions)
+    velocities = np.linspace(velocity_range[0], velocity_range[1], n_velocities)
+    grid_positions, grid_velocities = np.meshgrid(positions, velocities)
+    result = {"positions": positions, "velocities": velocities}
+    states = encode_grid(env, grid_positions.ravel(), grid_velocities.ravel())
+    shape = grid_positions.shape
+    if critic is not None:
+        values = [np.asarray(critic.predict_batch(states[start:start + batch_size]), dtype=float)
+                  for start in range(0, len(states), batch_size)]
+        result["value"] = np.concatenate(values).reshape(shape)
+    if actor is not None:
+        result["action"] = actor.get_greedy_actions(states).astype(np.int8).reshape(shape)
+    return result
+
+
+def save_heatmaps(grid, path, title=None):
+    """
+    Saves the value and action maps of value_map side by side as one image.
+    :param grid: dict returned by value_map
+    :param path: str, image file (the format follows the extension)
+    :param title: str (optional)
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    maps = [(name, label, cmap) for name, label, cmap in (("value", "Value", "viridis"),
+                                                          ("action", "Greedy action", "coolwarm"))
+            if name in grid]
+    positions, velocities = grid["positions"], grid["velocities"]
+    extent = (positions[0], positions[-1], velocities[0], velocities[-1])
+    fig, axes = plt.subplots(1, len(maps), figsize=(5 * len(maps), 4), squeeze=False)
+    for ax, (name, label, cmap) in zip(axes[0], maps):
+        image = ax.imshow(grid[name], origin="lower", aspect="auto", extent=extent, cmap=cmap,
+                          interpolation="nearest")
+        fig.colorbar(image, ax=ax)
+        ax.set(title=label, xlabel="Position", ylabel="Velocity")
+    if title:
+        fig.suptitle(title)
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+class PeriodicValueMap:
+    """
+    Saves the value and policy heatmaps every few training episodes.
+    """
+
+    def __init__(self, config):
+        """
+        :param every: int, save after every every-th episode
+        :param grid: [n_positions, n_velocities] (optional, default 200 x 200)
+        :param directory: str (optional, default value_maps)
+        :param format: str, image format (optional, default png)
+        :param arrays: bool, also save the arrays as .npz (optional, default False)
+        """
+        self.every = config["every"]
+        self.grid = config.get("grid", (200, 200))
+        self.directory = config.get("directory", "value_maps")
+        self.format = config.get("format", "png")
+        self.arrays = config.get("arrays", False)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def after_episode(self, episode, actor, critic, env):
+        """
+        Saves the maps if episode + 1 is a multiple of every.
+        :return: the path of the image, or None if nothing was saved
+        """
+        if (episode + 1) % self.every:
+            return None
+        grid = value_map(critic, actor, env, *self.grid)
+        name = os.path.join(self.directory, "value_map_{:05d}".format(episode))
+        if self.arrays:
+            np.savez(name + ".npz", **grid)
+        path = name + "." + self.format
+        save_heatmaps(grid, path, title="Episode {}".format(episode))
+        return path